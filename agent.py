@@ -1,37 +1,66 @@
 from openai import OpenAI
-from typing import Dict, List, Union, Tuple
-from github_client import GithubClient
+from typing import Callable, Dict, Iterator, List, Union, Tuple
 from typing import Dict, Optional
+import string
 class UndefinedVariableError(Exception):
     pass
 
 
+class LazyText:
+    """
+    Prompt variable whose text is produced piece by piece by a generator function, so
+    large data (e.g. commit diffs) is never held as one string before the final render.
+    """
+
+    def __init__(self, chunks: Callable[[], Iterator[str]]) -> None:
+        self.chunks = chunks
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.chunks())
+
+    def __str__(self) -> str:
+        return "".join(self.chunks())
+
+
 class Prompt:
-    def __init__(self, instructions: str, variables: Optional[Dict[str, Union[str, 'Prompt']]] = None) -> None:
+    def __init__(self, instructions: str, variables: Optional[Dict[str, Union[str, 'Prompt', LazyText]]] = None) -> None:
         self.instructions = instructions
         self.variables = variables
 
     def render(self) -> str:
-        try:
-            if self.variables is None:
-                return self.instructions
+        if self.variables is None:
+            return self.instructions
+        # Join the streamed pieces once instead of formatting intermediate copies
+        return "".join(self.iter_render())
+
+    def iter_render(self) -> Iterator[str]:
+        """Yields the rendered prompt in pieces, nested prompts and LazyText variables are streamed."""
+        if self.variables is None:
+            yield self.instructions
+            return
+
+        formatter = string.Formatter()
+        for literal_text, field_name, format_spec, conversion in formatter.parse(self.instructions):
+            if literal_text:
+                yield literal_text
+            if field_name is None:
+                continue
+            try:
+                value, _ = formatter.get_field(field_name, (), self.variables)
+            except KeyError as e:
+                # Raise a custom error if a variable is not defined
+                raise UndefinedVariableError(f"Variable '{e.args[0]}' is not defined") from e
+
+            if isinstance(value, Prompt) and not format_spec and not conversion:
+                # If the value is a Prompt, render it
+                yield from value.iter_render()
+            elif isinstance(value, LazyText) and not format_spec and not conversion:
+                yield from value
             else:
-                # Prepare a dictionary where we will store the rendered variables
-                rendered_variables = {}
-
-                for key, value in self.variables.items():
-                    if isinstance(value, Prompt):
-                        # If the value is a Prompt, render it
-                        rendered_variables[key] = value.render()
-                    else:
-                        # Otherwise, just use the string value
-                        rendered_variables[key] = value
-
-                # Format the instructions with the rendered variables
-                return self.instructions.format(**rendered_variables)
-        except KeyError as e:
-            # Raise a custom error if a variable is not defined
-            raise UndefinedVariableError(f"Variable '{e.args[0]}' is not defined") from e
+                if isinstance(value, (Prompt, LazyText)):
+                    value = value.render() if isinstance(value, Prompt) else str(value)
+                # Otherwise, format the value like str.format would
+                yield formatter.format_field(formatter.convert_field(value, conversion), format_spec)
 
     def __add__(self, other: 'Prompt') -> 'Prompt':
         # Combine the instructions
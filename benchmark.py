@@ -0,0 +1,422 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List
+from urllib.parse import parse_qs, urlencode, urlparse
+
+BENCHMARK_REPO_URL = "https://github.com/benchmark/synthetic"
+
+
+class StandInConfig:
+    def __init__(self, commits: int = 50, files_per_commit: int = 5, patch_lines: int = 40, reference_pages: int = 5,
+                 paragraphs_per_page: int = 20, completion_words: int = 400, github_latency: float = 0.0,
+                 reference_latency: float = 0.0, llm_latency: float = 0.2) -> None:
+        self.commits = commits
+        self.files_per_commit = files_per_commit
+        self.patch_lines = patch_lines
+        self.reference_pages = reference_pages
+        self.paragraphs_per_page = paragraphs_per_page
+        self.completion_words = completion_words
+        # Seconds added to every response of each service
+        self.github_latency = github_latency
+        self.reference_latency = reference_latency
+        self.llm_latency = llm_latency
+
+
+class StandInServer:
+    """
+    Local HTTP server standing in for the GitHub REST API (paged commit listing and commit
+    diffs), the GitHub GraphQL commit history, the reference pages and the OpenAI chat completions endpoint, all generated from
+    the config. It counts the requests and response bytes of each service.
+    """
+
+    def __init__(self, config: StandInConfig) -> None:
+        self.config = config
+        self.counters: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+        self.reset_counters()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self) -> None:
+                server.handle(self, "GET")
+
+            def do_POST(self) -> None:
+                server.handle(self, "POST")
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self) -> "StandInServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_counters(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            counters = self.counters
+            self.counters = {service: {"requests": 0, "bytes": 0} for service in ("github", "references", "llm")}
+            return counters
+
+    def reference_links(self) -> List[str]:
+        return [f"{self.url}/pages/{i}" for i in range(self.config.reference_pages)]
+
+    def handle(self, request: BaseHTTPRequestHandler, method: str) -> None:
+        parsed = urlparse(request.path)
+        body = request.rfile.read(int(request.headers.get("Content-Length") or 0)) if method == "POST" else b""
+        if method == "POST" and parsed.path.endswith("/chat/completions"):
+            service, latency = "llm", self.config.llm_latency
+        elif parsed.path.startswith("/pages/"):
+            service, latency = "references", self.config.reference_latency
+        else:
+            service, latency = "github", self.config.github_latency
+        if latency:
+            time.sleep(latency)
+
+        if service == "llm":
+            payload = json.loads(body or b"{}")
+            if payload.get("stream"):
+                self.stream_completion(request, payload)
+                return
+            status, headers, content = 200, {"Content-Type": "application/json"}, json.dumps(self.completion(payload)).encode()
+        elif service == "references":
+            status, headers, content = 200, {"Content-Type": "text/html; charset=utf-8"}, self.reference_page(parsed.path).encode()
+        elif parsed.path == "/graphql":
+            status, headers, content = self.graphql(json.loads(body or b"{}"))
+        else:
+            status, headers, content = self.github(parsed.path, parse_qs(parsed.query))
+
+        # Conditional requests are answered with a 304 like the real services
+        etag = f'"{hashlib.sha1(content).hexdigest()}"'
+        if status == 200 and request.headers.get("If-None-Match") == etag:
+            status, content = 304, b""
+        self.send(request, service, status, {**headers, "ETag": etag}, content)
+
+    def send(self, request: BaseHTTPRequestHandler, service: str, status: int, headers: Dict[str, str], content: bytes) -> None:
+        request.send_response(status)
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.send_header("Content-Length", str(len(content)))
+        request.end_headers()
+        request.wfile.write(content)
+        with self._lock:
+            self.counters[service]["requests"] += 1
+            self.counters[service]["bytes"] += len(content)
+
+    @staticmethod
+    def github_headers() -> Dict[str, str]:
+        return {"Content-Type": "application/json", "X-RateLimit-Limit": "5000", "X-RateLimit-Remaining": "4999",
+                "X-RateLimit-Reset": str(int(time.time()) + 3600)}
+
+    def synthetic_commit(self, i: int) -> Dict[str, str]:
+        sha = hashlib.sha1(str(i).encode()).hexdigest()
+        return {
+            "sha": sha,
+            "message": f"Synthetic commit {i}\n\nChanges {self.config.files_per_commit} files.",
+            "date": (datetime(2024, 1, 7, tzinfo=timezone.utc) - timedelta(minutes=10 * i)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "url": f"{BENCHMARK_REPO_URL}/commit/{sha}",
+        }
+
+    def github(self, path: str, query: Dict[str, List[str]]) -> tuple:
+        headers = self.github_headers()
+        match = re.fullmatch(r"/repos/([^/]+)/([^/]+)/commits(?:/([0-9a-f]{40}))?", path)
+        if not match:
+            return 404, headers, b'{"message": "Not Found"}'
+        if match.group(3):
+            return 200, headers, json.dumps({"sha": match.group(3), "files": self.commit_files(match.group(3))}).encode()
+
+        per_page = int(query.get("per_page", ["30"])[0])
+        page = int(query.get("page", ["1"])[0])
+        start = (page - 1) * per_page
+        end = min(start + per_page, self.config.commits)
+        if end < self.config.commits:
+            next_query = {key: values[0] for key, values in query.items()}
+            next_query["page"] = str(page + 1)
+            headers["Link"] = f'<{self.url}{path}?{urlencode(next_query)}>; rel="next"'
+        commits = [
+            {
+                "sha": commit["sha"],
+                "commit": {
+                    "message": commit["message"],
+                    "author": {"name": "Benchmark Author", "email": "author@example.com"},
+                    "committer": {"date": commit["date"]},
+                },
+                "html_url": commit["url"],
+            }
+            for commit in map(self.synthetic_commit, range(start, end))
+        ]
+        return 200, headers, json.dumps(commits).encode()
+
+    def graphql(self, payload: Dict[str, Any]) -> tuple:
+        """
+        Answers the commit history query in the shape of a recorded GitHub GraphQL response.
+        Like on GitHub, the author of some commits is null (a GitActor the API cannot resolve)
+        and pages are followed with the endCursor.
+        """
+        variables = payload.get("variables") or {}
+        if "history(" not in payload.get("query", ""):
+            return 200, self.github_headers(), json.dumps({"errors": [{"message": "Unsupported query"}]}).encode()
+        start = int(variables.get("after") or 0)
+        end = min(start + int(variables.get("first") or 100), self.config.commits)
+        nodes = [
+            {
+                "oid": commit["sha"],
+                "message": commit["message"],
+                "url": commit["url"],
+                "committedDate": commit["date"],
+                "changedFilesIfAvailable": self.config.files_per_commit,
+                "author": None if i % 10 == 9 else {"name": "Benchmark Author", "email": "author@example.com"},
+            }
+            for i, commit in ((i, self.synthetic_commit(i)) for i in range(start, end))
+        ]
+        history = {"pageInfo": {"hasNextPage": end < self.config.commits, "endCursor": str(end)}, "nodes": nodes}
+        data = {"data": {"repository": {"object": {"history": history}}}}
+        return 200, self.github_headers(), json.dumps(data).encode()
+
+    def commit_files(self, sha: str) -> List[Dict[str, Any]]:
+        files = []
+        for f in range(self.config.files_per_commit):
+            lines = [f"@@ -1,{self.config.patch_lines} +1,{self.config.patch_lines} @@"]
+            lines += [f"+    value_{n} = compute_{sha[:6]}({n}, {f})  # synthetic change" for n in range(self.config.patch_lines)]
+            files.append({"filename": f"src/module_{f}.py", "additions": self.config.patch_lines, "deletions": 0, "patch": "\n".join(lines)})
+        return files
+
+    def reference_page(self, path: str) -> str:
+        paragraphs = "".join(f"<p>Paragraph {n} of {path}, describing the synthetic reference material in a few sentences.</p>" for n in range(self.config.paragraphs_per_page))
+        return f"<html><head><title>Reference {path}</title><script>var ignored = 1;</script></head><body>{paragraphs}</body></html>"
+
+    def completion_text(self) -> str:
+        return " ".join(f"word{n}" for n in range(self.config.completion_words))
+
+    def completion(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        prompt_words = sum(len(str(message.get("content", "")).split()) for message in payload.get("messages", []))
+        return {
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "benchmark"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": self.completion_text()}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_words, "completion_tokens": self.config.completion_words, "total_tokens": prompt_words + self.config.completion_words},
+        }
+
+    def stream_completion(self, request: BaseHTTPRequestHandler, payload: Dict[str, Any]) -> None:
+        # Server-sent events without a length, the connection is closed at the end
+        request.close_connection = True
+        request.send_response(200)
+        request.send_header("Content-Type", "text/event-stream")
+        request.send_header("Connection", "close")
+        request.end_headers()
+        sent = 0
+        for word in self.completion_text().split(" "):
+            chunk = {"id": "chatcmpl-benchmark", "object": "chat.completion.chunk", "created": int(time.time()), "model": payload.get("model", "benchmark"),
+                     "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+            data = f"data: {json.dumps(chunk)}\n\n".encode()
+            request.wfile.write(data)
+            sent += len(data)
+        request.wfile.write(b"data: [DONE]\n\n")
+        with self._lock:
+            self.counters["llm"]["requests"] += 1
+            self.counters["llm"]["bytes"] += sent
+
+
+class HashingEmbeddingFunction:
+    """Offline stand-in for the Chroma embedding model: hashed bag of words, so the benchmark measures the indexing, not the model."""
+
+    def __init__(self, dimensions: int = 64) -> None:
+        self.dimensions = dimensions
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        vectors = []
+        for text in input:
+            vector = [0.0] * self.dimensions
+            for word in text.split():
+                vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.dimensions] += 1.0
+            vectors.append(vector)
+        return vectors
+
+    # Chroma persists the embedding function of a collection by name and config
+    @staticmethod
+    def name() -> str:
+        return "benchmark_hashing"
+
+    def get_config(self) -> Dict[str, Any]:
+        return {"dimensions": self.dimensions}
+
+    @staticmethod
+    def build_from_config(config: Dict[str, Any]) -> "HashingEmbeddingFunction":
+        return HashingEmbeddingFunction(config["dimensions"])
+
+
+def write_synthetic_pdf(file_path: str, pages: int, lines_per_page: int = 40) -> None:
+    """Writes a plain PDF with lines_per_page lines of text on each page."""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in range(pages):
+        text = "".join(f"({'Page %d line %d of the synthetic manual. The command sets the timestep.' % (page, line)}) Tj T* " for line in range(lines_per_page))
+        stream = f"BT /F1 9 Tf 11 TL 40 800 Td {text}ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>".encode()
+
+    content = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(content))
+        content += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(content)
+    content += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    content += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    content += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(file_path, 'wb') as f:
+        f.write(content)
+
+
+def measure(name: str, server: StandInServer, function: Callable[[str], Dict[str, Any]], memory_pass: bool = True) -> Dict[str, Any]:
+    """
+    Runs one scenario and returns its wall time, the traffic each stand-in served and, with
+    memory_pass, its peak Python memory. tracemalloc slows every allocation down several times,
+    so the memory is measured by a second run of the scenario, never by the timed one. Each run
+    gets an empty work directory.
+    """
+    server.reset_counters()
+    # Keep stdout for the JSON report
+    with contextlib.redirect_stdout(sys.stderr), tempfile.TemporaryDirectory() as work_dir:
+        start = time.perf_counter()
+        details = function(work_dir)
+        wall_time = time.perf_counter() - start
+    result = {"scenario": name, "wall_time_s": round(wall_time, 3), "traffic": server.reset_counters(), **details}
+
+    if memory_pass:
+        with contextlib.redirect_stdout(sys.stderr), tempfile.TemporaryDirectory() as work_dir:
+            tracemalloc.start()
+            try:
+                function(work_dir)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+        server.reset_counters()
+        result["peak_python_memory_mb"] = round(peak / 2**20, 2)
+    return result
+
+
+def github_scenario(server: StandInServer, args: argparse.Namespace, use_graphql: bool = False) -> Dict[str, Any]:
+    from github_client import GithubClient
+
+    client = GithubClient(token="benchmark", max_workers=args.max_workers, base_url=server.url, use_graphql=use_graphql)
+    commits = client.get_commits_and_diffs(BENCHMARK_REPO_URL, "main", num_commits=args.commits)
+    return {"commits": len(commits), "files": sum(len(commit.diffs) for commit in commits), "api_usage": client.scheduler.usage()}
+
+
+def pipeline_scenario(server: StandInServer, args: argparse.Namespace, work_dir: str) -> Dict[str, Any]:
+    # The OpenAI client is created on first use and reads its endpoint from the environment
+    os.environ["OPENAI_BASE_URL"] = f"{server.url}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    from generate_notebook import notebook_pipeline
+
+    metadata_file_path = os.path.join(work_dir, "metadata.txt")
+    with open(metadata_file_path, 'w') as f:
+        f.write("Synthetic notes for the benchmark notebook.\n" * 20)
+    responses = notebook_pipeline(
+        checker_iterations=args.checker_iterations,
+        gh_token="benchmark",
+        repo_url=BENCHMARK_REPO_URL,
+        branch="main",
+        commits=args.commits,
+        date_start=None,
+        date_end=None,
+        reference_links=server.reference_links(),
+        metadata_file_path=metadata_file_path,
+        max_workers=args.max_workers,
+        api_url=server.url,
+    )
+    return {"iterations": len(responses)}
+
+
+def pdf_scenario(server: StandInServer, args: argparse.Namespace, work_dir: str) -> Dict[str, Any]:
+    from pdf_agent import create_collection
+
+    pdf_file = os.path.join(work_dir, "synthetic_manual.pdf")
+    write_synthetic_pdf(pdf_file, args.pdf_pages)
+    database_path = os.path.join(work_dir, "chroma")
+    create_collection("benchmark", database_path, [pdf_file], workers=args.pdf_workers, embedding_function=HashingEmbeddingFunction())
+    # Second pass over the unchanged file, which should only hash and compare
+    start = time.perf_counter()
+    create_collection("benchmark", database_path, [pdf_file], workers=args.pdf_workers, embedding_function=HashingEmbeddingFunction())
+    return {"pages": args.pdf_pages, "reindex_unchanged_s": round(time.perf_counter() - start, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the notebook pipeline, the GitHub client and the PDF indexing against local stand-in servers.")
+    parser.add_argument("--scenarios", nargs="+", choices=["github", "graphql", "pipeline", "pdf"], default=["github", "graphql", "pipeline", "pdf"], help="Scenarios to run")
+    parser.add_argument("--commits", type=int, default=50, help="Number of synthetic commits")
+    parser.add_argument("--files_per_commit", type=int, default=5, help="Number of changed files in each commit")
+    parser.add_argument("--patch_lines", type=int, default=40, help="Number of lines in each file patch")
+    parser.add_argument("--reference_pages", type=int, default=5, help="Number of reference links")
+    parser.add_argument("--completion_words", type=int, default=400, help="Length of each chat completion")
+    parser.add_argument("--github_latency", type=float, default=0.0, help="Seconds added to every GitHub response")
+    parser.add_argument("--reference_latency", type=float, default=0.0, help="Seconds added to every reference page")
+    parser.add_argument("--llm_latency", type=float, default=0.2, help="Seconds added to every chat completion")
+    parser.add_argument("--checker_iterations", type=int, default=1, help="Number of checker iterations of the pipeline")
+    parser.add_argument("--max_workers", type=int, default=8, help="Maximum number of concurrent GitHub diff requests")
+    parser.add_argument("--pdf_pages", type=int, default=200, help="Number of pages of the synthetic PDF")
+    parser.add_argument("--pdf_workers", type=int, default=None, help="Number of processes extracting pages")
+    parser.add_argument("--skip_memory_pass", action="store_true", help="Do not run each scenario a second time to measure its peak Python memory")
+    parser.add_argument("--output", type=str, default=None, help="File to write the JSON report to (printed if not specified)")
+    args = parser.parse_args()
+
+    config = StandInConfig(
+        commits=args.commits, files_per_commit=args.files_per_commit, patch_lines=args.patch_lines,
+        reference_pages=args.reference_pages, completion_words=args.completion_words, github_latency=args.github_latency,
+        reference_latency=args.reference_latency, llm_latency=args.llm_latency,
+    )
+    results = []
+    memory_pass = not args.skip_memory_pass
+    with StandInServer(config) as server:
+        for scenario in args.scenarios:
+            if scenario == "github":
+                results.append(measure("github", server, lambda work_dir: github_scenario(server, args), memory_pass))
+            elif scenario == "graphql":
+                results.append(measure("graphql", server, lambda work_dir: github_scenario(server, args, use_graphql=True), memory_pass))
+            elif scenario == "pipeline":
+                results.append(measure("pipeline", server, lambda work_dir: pipeline_scenario(server, args, work_dir), memory_pass))
+            else:
+                results.append(measure("pdf", server, lambda work_dir: pdf_scenario(server, args, work_dir), memory_pass))
+
+    report = {
+        "config": vars(args),
+        "results": results,
+        # Peak resident memory of this process, the PDF extraction workers are not included
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
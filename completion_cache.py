@@ -0,0 +1,29 @@
+import hashlib
+import json
+from typing import Any, Dict, List, Optional
+from sqlite_store import SqliteStore
+
+
+class CompletionCache(SqliteStore):
+    """
+    Persistent store of chat completions, keyed on a hash of the model, the messages and
+    the request parameters. With bypass set, lookups always miss but fresh completions are
+    still stored.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 64 * 1024 * 1024, bypass: bool = False) -> None:
+        super().__init__(cache_dir, "completion_cache.sqlite", "completions", ["content"], max_bytes, ["hits", "misses"])
+        self.bypass = bypass
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict[str, Any]], params: Optional[Dict[str, Any]] = None) -> str:
+        payload = json.dumps({"model": model, "messages": messages, "params": params or {}}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        row = None if self.bypass else self.get_row(key)
+        self.record("misses" if row is None else "hits")
+        return None if row is None else row[0]
+
+    def put(self, key: str, content: str) -> None:
+        self.put_row(key, (content,), len(content.encode("utf-8")))
@@ -0,0 +1,143 @@
+import fnmatch
+from typing import Dict, List, Tuple
+from github_client import GithubCommitResponse
+from token_count import count_tokens
+
+# Files whose patches say little about the work done, they are only listed with their stats
+GENERATED_FILE_PATTERNS = [
+    "*package-lock.json", "*yarn.lock", "*pnpm-lock.yaml", "*poetry.lock", "*Pipfile.lock", "*Cargo.lock",
+    "*uv.lock", "*go.sum", "*composer.lock", "*Gemfile.lock",
+    "*.min.js", "*.min.css", "*.map", "*.ipynb", "*.svg", "*.pb.go", "*_pb2.py", "*_pb2_grpc.py",
+    "vendor/*", "*/vendor/*", "node_modules/*", "*/node_modules/*", "dist/*", "build/*", "third_party/*",
+]
+
+# Kept out of the budget for the one-line compaction note appended to the prompt
+PROMPT_NOTE_TOKENS = 40
+
+
+def is_generated_file(filename: str) -> bool:
+    return any(fnmatch.fnmatch(filename, pattern) for pattern in GENERATED_FILE_PATTERNS)
+
+
+def truncate_patch(patch: str, max_tokens: int) -> Tuple[str, bool]:
+    """Keeps the first lines of a patch that fit in max_tokens, noting how many lines were cut."""
+    if count_tokens(patch) <= max_tokens:
+        return patch, False
+    lines = patch.split("\n")
+    kept, used = [], 0
+    for line in lines:
+        line_tokens = count_tokens(line) + 1
+        if used + line_tokens > max_tokens:
+            break
+        kept.append(line)
+        used += line_tokens
+    kept.append(f"... [{len(lines) - len(kept)} more lines truncated]")
+    return "\n".join(kept), True
+
+
+class CompactionReport:
+    def __init__(self, token_budget: int) -> None:
+        self.token_budget = token_budget
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.truncated: List[str] = []
+        self.summarized: List[str] = []
+        self.dropped: List[str] = []
+
+    def summary(self) -> str:
+        lines = [f"Diff compaction: {self.tokens_before} -> {self.tokens_after} tokens (budget {self.token_budget})"]
+        if self.truncated:
+            lines.append(f"Truncated patches: {', '.join(self.truncated)}")
+        if self.summarized:
+            lines.append(f"Patches replaced by their stats: {', '.join(self.summarized)}")
+        if self.dropped:
+            lines.append(f"Files dropped: {', '.join(self.dropped)}")
+        return "\n".join(lines)
+
+    def prompt_note(self) -> str:
+        """Short note for the prompt, with counts instead of the file labels."""
+        if not (self.truncated or self.summarized or self.dropped):
+            return ""
+        return (f"Note: to fit the prompt, {len(self.truncated)} patches were truncated, {len(self.summarized)} were "
+                f"replaced by their stats and {len(self.dropped)} files were left out.")
+
+
+def compact_commits(commits: List[GithubCommitResponse], token_budget: int, max_patch_tokens: int = 2000) -> Tuple[List[GithubCommitResponse], CompactionReport]:
+    """
+    Fits the diffs of the commits into token_budget before they go into the prompt.
+    Commit headers are always kept. Patches of generated files (lockfiles, minified
+    assets, notebooks, vendored code) are replaced by their stats, other patches are
+    cut to max_patch_tokens. The stats line of every file is reserved first, then what
+    is left of the budget goes to patches by relevance (source files first, bigger
+    changes first); the others keep only their stats line. Files are only dropped when
+    even the stats lines do not fit. The commits keep their order.
+    """
+    report = CompactionReport(token_budget)
+
+    # (commit index, file index, diff, stats line tokens, patch tokens, source file)
+    candidates = []
+    file_counts = []
+    headers_tokens = 0
+    for c, commit in enumerate(commits):
+        # Lazy commits load their patches here, only the compacted version is kept
+        diffs = commit.diffs
+        file_counts.append(len(diffs))
+        headers_tokens += count_tokens(f"Commit({commit.sha[:7]}): {commit.message}\nAuthor: {commit.author_name} <{commit.author_email}>\nDate: {commit.committed_date}\nURL: {commit.url}\nDiffs:\n")
+        for f, diff in enumerate(diffs):
+            patch = diff['patch']
+            report.tokens_before += count_tokens(patch)
+            label = f"{commit.sha[:7]}:{diff['filename']}"
+            source = not is_generated_file(diff['filename'])
+            if not source:
+                patch = f"[patch omitted: generated file, +{diff['additions']}/-{diff['deletions']}]"
+                report.summarized.append(label)
+            else:
+                patch, truncated = truncate_patch(patch, max_patch_tokens)
+                if truncated:
+                    report.truncated.append(label)
+            compacted = {**diff, 'patch': patch}
+            stats_tokens = count_tokens(f"File: {diff['filename']} - Additions: {diff['additions']}, Deletions: {diff['deletions']}\nPatch:\n")
+            report.tokens_before += stats_tokens
+            candidates.append((c, f, compacted, stats_tokens, count_tokens(patch), source))
+    report.tokens_before += headers_tokens
+
+    # Every file keeps its stats line with a placeholder patch first, so every commit stays
+    # listed, then the rest of the budget upgrades files to their (cut) patch by relevance
+    placeholder = "[patch omitted to fit the token budget]"
+    placeholder_tokens = count_tokens(placeholder)
+    budget = token_budget - PROMPT_NOTE_TOKENS
+    used = headers_tokens + sum(stats_tokens + placeholder_tokens for _, _, _, stats_tokens, _, _ in candidates)
+
+    # Source files before generated ones, then by the size of the change
+    ranked = sorted(candidates, key=lambda item: (item[5], item[2]['additions'] + item[2]['deletions']), reverse=True)
+    # Only when even the stats lines do not fit are files dropped, least relevant first
+    while ranked and used > budget:
+        c, f, diff, stats_tokens, _, _ = ranked.pop()
+        used -= stats_tokens + placeholder_tokens
+        report.dropped.append(f"{commits[c].sha[:7]}:{diff['filename']}")
+
+    kept: Dict[Tuple[int, int], Dict[str, str]] = {}
+    for c, f, diff, stats_tokens, patch_tokens, source in ranked:
+        extra = patch_tokens - placeholder_tokens
+        if used + extra <= budget:
+            kept[(c, f)] = diff
+            used += extra
+        else:
+            kept[(c, f)] = {**diff, 'patch': placeholder}
+            if source:
+                report.summarized.append(f"{commits[c].sha[:7]}:{diff['filename']}")
+    report.tokens_after = used
+
+    compacted_commits = []
+    for c, commit in enumerate(commits):
+        diffs = [kept[(c, f)] for f in range(file_counts[c]) if (c, f) in kept]
+        compacted_commits.append(GithubCommitResponse(
+            message=commit.message,
+            committed_date=commit.committed_date,
+            sha=commit.sha,
+            author_name=commit.author_name,
+            author_email=commit.author_email,
+            url=commit.url,
+            diffs=diffs
+        ))
+    return compacted_commits, report
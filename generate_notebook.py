@@ -1,27 +1,98 @@
 import argparse
 import os
-import requests
 from openai import OpenAI
-from typing import Dict, List, Union, Tuple
-from github_client import GithubClient
+from typing import Callable, Dict, List, Union, Tuple
+from github_client import GithubClient, GithubCommitResponse
+from github_cache import GithubCache
+from git_mirror_client import GitMirrorClient
+from diff_compaction import compact_commits
+from token_count import count_tokens
+from reference_loader import ReferenceCache, ReferenceLoader, ReferenceResult, reference_report
 from typing import Dict, Optional
 import datetime
-from bs4 import BeautifulSoup
-import requests
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from agent import Prompt
-
-
-        
-
-def openai_chat_completion(prompt: Prompt) -> str:
-    client = OpenAI()
+from agent import LazyText, Prompt
+from completion_cache import CompletionCache
+from llm_batch import BatchCollector, DeferredCompletion, DirectBatchBackend, OpenAIBatchBackend, collect_batch, submit_batch
+from task_graph import TaskGraph
+from pipeline_state import PipelineState, text_hash
+from notebook_writer import IterationStreamWriter, remove_stale_iteration_files, write_iteration_file
+from tracing import tracer
+import threading
+
+
+# One OpenAI client for the whole run, so every completion reuses its connection pool.
+# The client reads OPENAI_API_KEY and OPENAI_BASE_URL (e.g. a local stub server) from the environment.
+_openai_client: Optional[OpenAI] = None
+_openai_client_lock = threading.Lock()
+
+# Set by main() when --cache_dir is given
+completion_cache: Optional[CompletionCache] = None
+
+# Set by main() with --llm_batch submit, completions missing from the cache are deferred to it
+batch_collector: Optional[BatchCollector] = None
+
+def get_openai_client() -> OpenAI:
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            _openai_client = OpenAI()
+        return _openai_client
+
+def openai_chat_completion(prompt: Prompt, model: str = "gpt-4o-mini", on_token: Optional[Callable[[str], None]] = None) -> str:
+    """Returns the completion of the prompt. With on_token, the response is streamed and every piece is passed to it as it arrives."""
     prompt_text = prompt.render()
-    response = client.chat.completions.create(
-    model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt_text}]
-    )
-    return response.choices[0].message.content
+    messages = [{"role": "user", "content": prompt_text}]
+
+    with tracer.span("llm_completion", model=model) as span:
+        if span.recording:
+            span.set(tokens_in=count_tokens(prompt_text))
+
+        # Identical requests (e.g. a workflow retry with no new commits) are answered from the cache
+        key = CompletionCache.make_key(model, messages) if completion_cache else None
+        if completion_cache:
+            cached = completion_cache.get(key)
+            if cached is not None:
+                span.set(cache="hit")
+                if on_token:
+                    on_token(cached)
+                return cached
+            if batch_collector:
+                # The request goes into the batch job, the pipeline resumes from the cache once it is done
+                batch_collector.add(key, model, messages)
+                raise DeferredCompletion(key)
+
+        usage = None
+        if on_token:
+            stream = get_openai_client().chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True
+            )
+            pieces = []
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    on_token(delta)
+                    pieces.append(delta)
+            content = "".join(pieces)
+        else:
+            response = get_openai_client().chat.completions.create(
+                model=model,
+                messages=messages
+            )
+            content = response.choices[0].message.content
+            usage = response.usage
+        if span.recording:
+            span.set(cache="miss" if completion_cache else None, tokens_out=usage.completion_tokens if usage else count_tokens(content or ""))
+            if usage:
+                span.set(tokens_in=usage.prompt_tokens)
+        if completion_cache and content is not None:
+            completion_cache.put(key, content)
+        return content
 
 
 def general_instruction_prompt() -> Prompt:
@@ -74,25 +145,19 @@ def get_current_week_dates() -> Tuple[str, str]:
     end_of_week = start_of_week + datetime.timedelta(days=6)  # Saturday of the current week
     return start_of_week.strftime("%Y-%m-%d"), end_of_week.strftime("%Y-%m-%d")
 
-# Modified github_data_prompt function to support getting commits for the current week
-def github_data_prompt(gh_token: str, repo_url: str, branch: str, commits: Optional[int], date_start: Optional[str], date_end: Optional[str]) -> Prompt:
-    instructions = """
-    The following data is taken from the GitHub RESTful API. It includes information from a specific repository in a structured format:
-    Format of the Data:
-    Repository URL: {repo_url}
-    Branch: {branch}
-    Number of Commits: {num_commits}
+def create_github_client(gh_token: str, max_workers: int = 8, cache_dir: Optional[str] = None, backend: str = "rest", mirror_dir: str = ".cache/mirrors", api_url: str = "https://api.github.com", pipelines: int = 1, timeout: float = 30.0) -> GithubClient:
+    cache = GithubCache(cache_dir) if cache_dir and backend != "git" else None
+    if backend == "git":
+        return GitMirrorClient(token=gh_token, mirror_dir=mirror_dir, max_workers=max_workers)
+    return GithubClient(token=gh_token, max_workers=max_workers, cache=cache, use_graphql=backend == "graphql", base_url=api_url, pool_size=max_workers * pipelines, timeout=timeout)
 
-    Data:
-    {GH_DATA}
-    """
-    
+def fetch_github_commits(gh_token: str, repo_url: str, branch: str, commits: Optional[int], date_start: Optional[str], date_end: Optional[str], max_workers: int = 8, cache_dir: Optional[str] = None, backend: str = "rest", mirror_dir: str = ".cache/mirrors", api_url: str = "https://api.github.com", client: Optional[GithubClient] = None) -> List[GithubCommitResponse]:
     # If no date range is provided, fetch the current week’s commits
     if not date_start or not date_end:
         date_start, date_end = get_current_week_dates()
     
-    # Initialize the GitHub client
-    client = GithubClient(token=gh_token)
+    # Initialize the GitHub client, unless one is shared between several notebooks
+    client = client or create_github_client(gh_token, max_workers, cache_dir, backend, mirror_dir, api_url)
     
     # Fetch commits with diffs, filtering by date if commits are not specified
     github_retrieved_data = client.get_commits_and_diffs(
@@ -103,8 +168,29 @@ def github_data_prompt(gh_token: str, repo_url: str, branch: str, commits: Optio
         date_end=date_end
     )
     
-    # Format the retrieved commit data for inclusion in the prompt
-    formatted_data = "\n\n".join([str(commit) for commit in github_retrieved_data])
+    if not isinstance(client, GitMirrorClient):
+        print(f"GitHub API usage: {client.scheduler.usage()}")
+    if client.cache:
+        print(f"GitHub cache: {client.cache.stats()}")
+    return github_retrieved_data
+
+def github_commits_prompt(github_retrieved_data: List[GithubCommitResponse], repo_url: str, branch: str, commits: Optional[int], token_budget: int = 60000, max_patch_tokens: int = 2000, commit_batch_size: int = 0, summary_workers: int = 4) -> Prompt:
+    instructions = """
+    The following data is taken from the GitHub RESTful API. It includes information from a specific repository in a structured format:
+    Format of the Data:
+    Repository URL: {repo_url}
+    Branch: {branch}
+    Number of Commits: {num_commits}
+
+    Data:
+    {GH_DATA}
+    """
+
+    if commit_batch_size and len(github_retrieved_data) > commit_batch_size:
+        # Map step: summarize batches of commits in parallel, the notebook prompt only gets the summaries
+        formatted_data = summarize_commit_batches(github_retrieved_data, repo_url, branch, commit_batch_size, summary_workers, token_budget, max_patch_tokens)
+    else:
+        formatted_data = format_commits(github_retrieved_data, token_budget, max_patch_tokens)
 
     variables = {
         'repo_url': repo_url,
@@ -115,7 +201,58 @@ def github_data_prompt(gh_token: str, repo_url: str, branch: str, commits: Optio
     
     return Prompt(instructions, variables)
 
-def references_prompt(links: list) -> Prompt:
+def format_commits(github_retrieved_data: List[GithubCommitResponse], token_budget: int, max_patch_tokens: int) -> LazyText:
+    # Fit the diffs into the token budget, ranking source changes over generated files
+    compaction_note = ""
+    if token_budget:
+        github_retrieved_data, report = compact_commits(github_retrieved_data, token_budget, max_patch_tokens)
+        print(report.summary())
+        if report.prompt_note():
+            compaction_note = "\n\n" + report.prompt_note()
+
+    # Format the retrieved commit data for inclusion in the prompt, streamed one commit at a time
+    # when the prompt is rendered (the cache stays open for commits that read their patches back)
+    def formatted_commits():
+        for i, commit in enumerate(github_retrieved_data):
+            if i:
+                yield "\n\n"
+            yield from commit.iter_text()
+        yield compaction_note
+
+    return LazyText(formatted_commits)
+
+def commit_batch_summary_prompt(repo_url: str, branch: str, commits_data: LazyText) -> Prompt:
+    instructions = """
+    The following data is a batch of commits taken from the GitHub RESTful API, with the diff of every file changed.
+    It is only one part of the week of work, the summaries of all the batches will be combined later into a notebook.
+    Write a detailed summary of the work done in these commits: what was implemented or fixed, in which files,
+    and the programming and machine learning concepts and ideas applied in the code. Mention the short SHA of each commit.
+
+    Repository URL: {repo_url}
+    Branch: {branch}
+
+    Data:
+    {GH_DATA}
+    """
+    return Prompt(instructions, {'repo_url': repo_url, 'branch': branch, 'GH_DATA': commits_data})
+
+def summarize_commit_batches(github_retrieved_data: List[GithubCommitResponse], repo_url: str, branch: str, batch_size: int, max_workers: int, token_budget: int, max_patch_tokens: int) -> str:
+    """Summarizes batches of batch_size commits with up to max_workers concurrent completions, keeping the commit order."""
+    batches = [github_retrieved_data[i:i + batch_size] for i in range(0, len(github_retrieved_data), batch_size)]
+
+    def summarize(batch: List[GithubCommitResponse]) -> str:
+        # Each batch is compacted on its own, so every map call fits the token budget
+        return openai_chat_completion(commit_batch_summary_prompt(repo_url, branch, format_commits(batch, token_budget, max_patch_tokens)))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as executor:
+        summaries = list(executor.map(summarize, batches))
+
+    return "\n\n".join(
+        f"Summary of commits {batch[-1].sha[:7]}..{batch[0].sha[:7]} ({len(batch)} commits, {batch[-1].committed_date} to {batch[0].committed_date}):\n{summary}"
+        for batch, summary in zip(batches, summaries)
+    )
+
+def references_prompt(references: List[ReferenceResult]) -> Prompt:
     instructions = """
     The following data is extracted from the provided reference links. Each link contains important information that will be used to
     explain the technical concepts implemented in the code. The content extracted will be summarized and referenced in the final markdown document.
@@ -126,24 +263,12 @@ def references_prompt(links: list) -> Prompt:
 
     references_data = []
     
-    for link in links:
-        try:
-            response = requests.get(link)
-            soup = BeautifulSoup(response.content, 'html.parser')
-
-            # Example extraction logic:
-            # Extract the title of the page
-            title = soup.title.string if soup.title else "No Title"
-            
-            # Extract all paragraph texts
-            paragraphs = soup.find_all('p')
-            content = ' '.join([para.get_text() for para in paragraphs])
-
+    for reference in references:
+        if reference.ok:
             # Combine title and content
-            references_data.append(f"Title: {title}\nContent: {content[:500]}...")  # Limiting content length for brevity
-
-        except Exception as e:
-            references_data.append(f"Error retrieving data from {link}: {e}")
+            references_data.append(f"Title: {reference.title}\nContent: {reference.content[:500]}...")  # Limiting content length for brevity
+        else:
+            references_data.append(f"Error retrieving data from {reference.url}: {reference.error}")
 
     variables = {
         'REFERENCES_DATA': "\n\n".join(references_data)
@@ -166,7 +291,7 @@ def metadata_notes_prompt(files_path: str) -> Prompt:
     
 
     
-def format_final_response(raw_response: str) -> str:
+def format_final_response(raw_response: str, on_token: Optional[Callable[[str], None]] = None) -> str:
     intructions = """Given the generation of the  notebook report I want you to answer the following questions. 
                     Make sure is not a very big response. Mention all the topics without explaining them for too long.
                     Work accomplished:
@@ -182,13 +307,13 @@ def format_final_response(raw_response: str) -> str:
 
     prompt = Prompt(intructions, {"RAW_RESPONSE":raw_response})
 
-    return openai_chat_completion(prompt)
+    return openai_chat_completion(prompt, on_token=on_token)
  
 
 
 
 
-def response_checker(response: str, instruction_prompt: Prompt )-> str:
+def response_checker(response: str, instruction_prompt: Prompt, on_token: Optional[Callable[[str], None]] = None)-> str:
     instructions = """
     You are given a response I would want you to revised if the initial instructions 
     from the prompt were meet. If that the case could you list what where the things that dindt
@@ -198,8 +323,8 @@ def response_checker(response: str, instruction_prompt: Prompt )-> str:
     {instruction_prompt}
     """
     checker_prompt = Prompt(instructions, {'instruction_prompt': instruction_prompt})
-    return openai_chat_completion(checker_prompt)
-def improve_response_with_checker(checker_response: str, genenerated_response: str)-> str:
+    return openai_chat_completion(checker_prompt, on_token=on_token)
+def improve_response_with_checker(checker_response: str, genenerated_response: str, on_token: Optional[Callable[[str], None]] = None)-> str:
     instructions = """
     I will give you two responses. the first one is a first generation of a text the second one is the response
     from a critique of the things that are wrong or could improve. With this information you will create a new response
@@ -210,32 +335,252 @@ def improve_response_with_checker(checker_response: str, genenerated_response: s
     {checker_response}
     """
     prompt = Prompt(instructions, {'generated_response': genenerated_response, 'checker_response': checker_response})
-    return openai_chat_completion(prompt)
+    return openai_chat_completion(prompt, on_token=on_token)
 
 
 
 
 
-def notebook_pipeline(checker_iterations: int, gh_token: str, repo_url: str, branch: str, commits: Optional[int], date_start: Optional[str], date_end: Optional[str], reference_links: List[str], metadata_file_path: str) -> List[Tuple[str, str, str]]:
+def notebook_pipeline(checker_iterations: int, gh_token: str, repo_url: str, branch: str, commits: Optional[int], date_start: Optional[str], date_end: Optional[str], reference_links: List[str], metadata_file_path: str, max_workers: int = 8, cache_dir: Optional[str] = None, backend: str = "rest", mirror_dir: str = ".cache/mirrors", api_url: str = "https://api.github.com", token_budget: int = 60000, max_patch_tokens: int = 2000, commit_batch_size: int = 0, summary_workers: int = 4, reference_loader: Optional[ReferenceLoader] = None, state_dir: Optional[str] = None, stream_folder: Optional[str] = None, github_client: Optional[GithubClient] = None) -> List[Tuple[str, str, str]]:
+    """
+    Runs the pipeline as stage graphs: the GitHub, references and metadata stages gather their
+    data concurrently, then the first generation and the checker rounds follow (see
+    add_checker_rounds). Stage timings are printed at the end.
+
+    With state_dir, the run is checkpointed there (see PipelineState). When the references and
+    metadata are unchanged and the week only gained commits, the last notebook gets a single
+    revision pass with the new ones, which replaces its revised response and answer (the
+    diffs of the known commits are read back from the GitHub cache instead of fetched again). When
+    nothing changed at all the previous generations are returned as they are.
+
+    A github_client and reference_loader can be passed to share their connections, caches
+    and rate-limit budget between several pipelines (see run_notebook_jobs).
+    """
     # Generate the initial prompt components
     initial_prompt = general_instruction_prompt()
-    github_data = github_data_prompt(gh_token, repo_url, branch, commits, date_start, date_end)
-    references = references_prompt(reference_links)
-    metadata = metadata_notes_prompt(metadata_file_path)
-    final_prompt = initial_prompt + github_data + references + metadata
-    responses = []
-    response = openai_chat_completion(final_prompt)
-    
+
+    state = None
+    if state_dir:
+        settings = {
+            'repo_url': repo_url, 'branch': branch, 'commits': commits, 'date_start': date_start, 'date_end': date_end,
+            'checker_iterations': checker_iterations, 'token_budget': token_budget, 'max_patch_tokens': max_patch_tokens,
+            'commit_batch_size': commit_batch_size,
+        }
+        state = PipelineState.load(state_dir, settings)
+
+    gather = TaskGraph(max_workers=3)
+    gather.add("github_commits", lambda: fetch_github_commits(gh_token, repo_url, branch, commits, date_start, date_end, max_workers, cache_dir, backend, mirror_dir, api_url, github_client))
+    gather.add("references", lambda: gather_references(reference_links, reference_loader or ReferenceLoader()))
+    gather.add("metadata", lambda: metadata_notes_prompt(metadata_file_path))
+    inputs = gather.run()
+    timings = dict(gather.timings)
+    github_commits, references, metadata = inputs["github_commits"], inputs["references"], inputs["metadata"]
+
+    references_hash, metadata_hash = text_hash(references.render()), text_hash(metadata.render())
+    # A full run is needed unless the previous commits are all still there and nothing else changed
+    mode, new_commits = "full", github_commits
+    if state and state.responses and (state.references_hash, state.metadata_hash) == (references_hash, metadata_hash):
+        processed_shas = set(state.shas)
+        if processed_shas <= {commit.sha for commit in github_commits}:
+            new_commits = [commit for commit in github_commits if commit.sha not in processed_shas]
+            mode = "incremental" if new_commits else "unchanged"
+
+    generation = TaskGraph(max_workers=4)
+    if mode == "full":
+        generation.add("github_data", lambda: github_commits_prompt(github_commits, repo_url, branch, commits, token_budget, max_patch_tokens, commit_batch_size, summary_workers))
+        generation.add("final_prompt", lambda github_data: initial_prompt + github_data + references + metadata, ["github_data"])
+        add_checker_rounds(generation, "final_prompt", initial_prompt, checker_iterations, IterationStreamWriter(stream_folder) if stream_folder else None)
+        results = generation.run()
+        responses = [
+            (results[f"response_{i}"], results[f"checker_{i}"], results[f"response_{i+1}"], results[f"answer_{i}"])
+            for i in range(checker_iterations)
+        ]
+    elif mode == "incremental":
+        # Only new commits: one revision pass over the last notebook
+        print(f"Incremental run with {len(new_commits)} new commit(s).")
+        previous_response = state.responses[-1][2]
+        generation.add("github_data", lambda: github_commits_prompt(new_commits, repo_url, branch, len(new_commits), token_budget, max_patch_tokens))
+        generation.add("revised_update", lambda github_data: update_response_with_new_commits(previous_response, github_data), ["github_data"])
+        generation.add("answer_update", format_final_response, ["revised_update"])
+        results = generation.run()
+        print(f"Revised the last iteration with {', '.join(commit.sha[:7] for commit in new_commits)}.")
+        # The revision replaces the last notebook, so the iterations do not grow with every run
+        initial_response, checker_response = state.responses[-1][:2]
+        responses = state.responses[:-1] + [(initial_response, checker_response, results["revised_update"], results["answer_update"])]
+    else:
+        print("No new commits and unchanged inputs, reusing the previous generations.")
+        responses = list(state.responses)
+    timings.update(generation.timings)
+
+    if state:
+        state.set_commits(github_commits)
+        state.references_hash, state.metadata_hash = references_hash, metadata_hash
+        state.responses = responses
+        state.save()
+
+    print(stage_timings_report(timings))
+    return responses
+
+def update_response_with_new_commits(previous_response: str, new_commits_data: Prompt) -> str:
+    instructions = """
+    I will give you a notebook generated earlier this week and the GitHub data of the commits made since it was generated.
+    Update the notebook so it also covers the new commits, keeping the same structure and everything from the previous
+    version that is still valid. Only answer with the updated notebook.
+    Notebook:
+    {previous_response}
+    New commits:
+    {new_commits}
+    """
+    prompt = Prompt(instructions, {'previous_response': previous_response, 'new_commits': new_commits_data})
+    return openai_chat_completion(prompt)
+
+def gather_references(reference_links: List[str], reference_loader: ReferenceLoader) -> Prompt:
+    """Fetches and validates the reference links, then builds their prompt."""
+    references = reference_loader.fetch_all(reference_links)
+    print(reference_report(references))
+    if reference_loader.cache:
+        print(f"Reference cache: {reference_loader.cache.stats()}")
+    check_reference_links(references)
+    return references_prompt(references)
+
+def add_checker_rounds(graph: TaskGraph, final_prompt_task: str, initial_prompt: Prompt, checker_iterations: int, stream_writer: Optional[IterationStreamWriter] = None) -> None:
+    """
+    Adds the generation and checker rounds to the graph: response_i+1 is the revision of
+    response_i with its critique, and the weekly answers of a round only depend on its revised
+    response, so they are generated while the next round is critiqued.
+
+    With a stream_writer, every completion is streamed into its sections of the iteration
+    files (response_i+1 is both the revised response of iteration i and the initial response
+    of iteration i+1), and iteration i is saved as soon as its answers are complete.
+    """
+    def streamed(function: Callable[..., str], sections: List[Tuple[int, str]], finishes: Optional[int] = None) -> Callable[..., str]:
+        if stream_writer is None:
+            return function
+
+        def write(text: str) -> None:
+            for index, _ in sections:
+                stream_writer.write(index, text)
+
+        def run(*args):
+            for index, title in sections:
+                stream_writer.begin_section(index, title)
+            result = function(*args, on_token=write)
+            for index, _ in sections:
+                stream_writer.end_section(index)
+            if finishes is not None:
+                stream_writer.finish(finishes)
+            return result
+        return run
+
+    # Iterations are only written when there is at least one checker round
+    first_sections = [(0, "Initial Response")] if checker_iterations else []
+    graph.add("response_0", streamed(openai_chat_completion, first_sections), [final_prompt_task])
     for i in range(checker_iterations):
-        checker_response = response_checker(response, initial_prompt)
-        revised_response = improve_response_with_checker(checker_response, response)
-        answer_weekly_questions = format_final_response(revised_response)
-        responses.append((response, checker_response, revised_response, answer_weekly_questions))
-        response = revised_response
+        revised_sections = [(i, "Revised Response")] + ([(i + 1, "Initial Response")] if i + 1 < checker_iterations else [])
+        graph.add(f"checker_{i}", streamed(lambda response, on_token=None: response_checker(response, initial_prompt, on_token), [(i, "Checker Response")]), [f"response_{i}"])
+        graph.add(f"response_{i+1}", streamed(improve_response_with_checker, revised_sections), [f"checker_{i}", f"response_{i}"])
+        graph.add(f"answer_{i}", streamed(format_final_response, [(i, "Asnwer to Notebook")], finishes=i), [f"response_{i+1}"])
+
+def stage_timings_report(timings: Dict[str, float]) -> str:
+    lines = ["Stage timings:"]
+    for name, seconds in timings.items():
+        lines.append(f"  {name:<16}{seconds:>8.2f}s")
+    return "\n".join(lines)
+
+
+def load_manifest(file_path: str) -> List[Dict]:
+    """
+    Load the batch jobs from a JSON file holding a list of objects with the repo_url, branch,
+    member and metadata_file_path of each notebook. A job may also set its own
+    reference_file_path, commits, date_start, date_end and output_folder.
+    """
+    with open(file_path, 'r') as f:
+        jobs = json.load(f)
+    if not isinstance(jobs, list) or not jobs:
+        raise ValueError(f"No jobs found in the manifest {file_path}.")
+    members = set()
+    for job in jobs:
+        missing = [key for key in ("repo_url", "branch", "member", "metadata_file_path") if not job.get(key)]
+        if missing:
+            raise ValueError(f"Manifest job {job} is missing {', '.join(missing)}.")
+        if job["member"] in members:
+            raise ValueError(f"Member {job['member']} appears twice in the manifest {file_path}.")
+        members.add(job["member"])
+    return jobs
+
+def run_notebook_job(job: Dict, args: argparse.Namespace, gh_token: str, github_client: GithubClient, reference_loader: ReferenceLoader) -> Optional[List[Tuple[str, str, str, str]]]:
+    """
+    Generates and saves the notebook of one job with the clients shared by the batch.
+    Returns None when its first-pass completions were deferred to the LLM batch.
+    """
+    reference_links = load_reference_links(job.get("reference_file_path") or args.reference_file_path)
+    check_metadata_file(job["metadata_file_path"])
+    output_folder = job["output_folder"]
+    os.makedirs(output_folder, exist_ok=True)
+
+    try:
+        responses = notebook_pipeline(
+            checker_iterations=args.checker_iterations,
+            gh_token=gh_token,
+            repo_url=job["repo_url"],
+            branch=job["branch"],
+            commits=job.get("commits", args.commits),
+            date_start=job.get("date_start", args.date_start),
+            date_end=job.get("date_end", args.date_end),
+            reference_links=reference_links,
+            reference_loader=reference_loader,
+            github_client=github_client,
+            state_dir=output_folder if args.incremental else None,
+            stream_folder=output_folder if args.stream else None,
+            metadata_file_path=job["metadata_file_path"],
+            max_workers=args.max_workers,
+            cache_dir=args.cache_dir,
+            backend=args.backend,
+            mirror_dir=args.mirror_dir,
+            api_url=args.api_url,
+            token_budget=args.token_budget,
+            max_patch_tokens=args.max_patch_tokens,
+            commit_batch_size=args.commit_batch_size,
+            summary_workers=args.summary_workers
+        )
+    except DeferredCompletion:
+        print(f"First-pass completions of {job['member']} deferred to the LLM batch.")
+        return None
     
+    # Save each iteration response to a separate file (streamed iterations are already saved
+    # with the same content, rewriting them is cheap and covers reused and incremental runs)
+    for i, iteration_responses in enumerate(responses):
+        file_path = write_iteration_file(output_folder, i, iteration_responses)
+        if not args.stream:
+            print(f"Iteration {i+1} has been saved to {file_path}")
+    # A previous run with more checker iterations must not leave its later notebooks behind
+    remove_stale_iteration_files(output_folder, len(responses))
     return responses
 
+def run_notebook_jobs(jobs: List[Dict], args: argparse.Namespace, gh_token: str, github_client: GithubClient, reference_loader: ReferenceLoader) -> Dict[str, Optional[Exception]]:
+    """
+    Runs the jobs concurrently, args.jobs at a time. They share one GitHub client (one session
+    pool, response cache and rate-limit budget), one reference loader and the completion
+    cache, so each job only pays for its own data. A failing job does not stop the others,
+    the error of each member is returned (None when its notebook was saved).
+    """
+    def run(job: Dict) -> Tuple[Optional[Exception], float]:
+        start = time.perf_counter()
+        try:
+            run_notebook_job(job, args, gh_token, github_client, reference_loader)
+            return None, time.perf_counter() - start
+        except Exception as e:
+            print(f"Notebook of {job['member']} failed: {e}")
+            return e, time.perf_counter() - start
 
+    with ThreadPoolExecutor(max_workers=max(1, min(args.jobs, len(jobs)))) as executor:
+        outcomes = list(executor.map(run, jobs))
+
+    if len(jobs) > 1:
+        print("Batch results:")
+        for job, (error, seconds) in zip(jobs, outcomes):
+            print(f"  {job['member']:<24}{seconds:>8.2f}s  {'failed: ' + str(error) if error else job['output_folder']}")
+    return {job["member"]: error for job, (error, _) in zip(jobs, outcomes)}
 
 def load_reference_links(file_path: str) -> List[str]:
     """Load reference links from a text file where each line is a different link."""
@@ -250,18 +595,11 @@ def load_reference_links(file_path: str) -> List[str]:
     
     return links
 
-def check_reference_links(reference_links):
-    """Check if reference links return valid content."""
-    for link in reference_links:
-        try:
-            response = requests.get(link)
-            if response.status_code != 200:
-                raise ValueError(f"Error fetching {link}: Status code {response.status_code}")
-            soup = BeautifulSoup(response.content, 'html.parser')
-            if not soup.get_text(strip=True):
-                raise ValueError(f"No valid content found in {link}")
-        except Exception as e:
-            raise ValueError(f"Error processing {link}: {e}")
+def check_reference_links(references: List[ReferenceResult]):
+    """Check if the fetched reference links returned valid content."""
+    for reference in references:
+        if not reference.ok:
+            raise ValueError(f"Error processing {reference.url}: {reference.error}")
 
 def check_metadata_file(metadata_file_path):
     """Check if the metadata file exists and is non-empty."""
@@ -274,17 +612,45 @@ def main():
     parser = argparse.ArgumentParser(description="Generate a weekly research notebook with multiple iterations.")
     
     parser.add_argument("--gh_token", type=str, help="GitHub API token (if not specified, will read from GITHUB_TOKEN environment variable)")
-    parser.add_argument("--repo_url", type=str, required=True, help="GitHub repository URL")
-    parser.add_argument("--branch", type=str, required=True, help="Branch name")
+    parser.add_argument("--repo_url", type=str, help="GitHub repository URL (required without --manifest)")
+    parser.add_argument("--branch", type=str, help="Branch name (required without --manifest)")
     parser.add_argument("--commits", type=int, help="Number of commits to fetch", default=None)
     parser.add_argument("--date_start", type=str, help="Start date in YYYY-MM-DD format", default=None)
     parser.add_argument("--date_end", type=str, help="End date in YYYY-MM-DD format", default=None)
-    parser.add_argument("--reference_file_path", type=str, required=True, help="Path to the text file containing reference links")
-    parser.add_argument("--metadata_file_path", type=str, required=True, help="Path to the metadata notes file")
+    parser.add_argument("--reference_file_path", type=str, required=True, help="Path to the text file containing reference links (the default of every manifest job)")
+    parser.add_argument("--metadata_file_path", type=str, help="Path to the metadata notes file (required without --manifest)")
     parser.add_argument("--checker_iterations", type=int, default=1, help="Number of checker iterations")
-    parser.add_argument("--output_folder", type=str, default="notebook_iterations", help="Folder to save the generated notebooks")
+    parser.add_argument("--output_folder", type=str, default="notebook_iterations", help="Folder to save the generated notebooks (with --manifest, each member gets a subfolder)")
+    parser.add_argument("--max_workers", type=int, default=8, help="Maximum number of concurrent GitHub diff requests")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Folder for the persistent GitHub response and reference caches (disabled if not specified)")
+    parser.add_argument("--backend", type=str, choices=["rest", "graphql", "git"], default="rest", help="Read commits from the GitHub REST API, from batched GraphQL queries (diffs still use REST) or from a local bare git mirror")
+    parser.add_argument("--api_url", type=str, default="https://api.github.com", help="Base URL of the GitHub REST API, e.g. https://HOST/api/v3 for GitHub Enterprise (GraphQL is then read from https://HOST/api/graphql) or a local stand-in server")
+    parser.add_argument("--token_budget", type=int, default=60000, help="Maximum number of tokens of GitHub data in the prompt (0 disables diff compaction)")
+    parser.add_argument("--max_patch_tokens", type=int, default=2000, help="Maximum number of tokens kept from a single file patch")
+    parser.add_argument("--commit_batch_size", type=int, default=0, help="Summarize commits in batches of this size before the notebook generation (0 sends all commits at once)")
+    parser.add_argument("--summary_workers", type=int, default=4, help="Maximum number of batch summaries generated concurrently")
+    parser.add_argument("--github_timeout", type=float, default=30.0, help="Timeout in seconds for each GitHub API request, stalled requests are retried")
+    parser.add_argument("--reference_timeout", type=float, default=15.0, help="Timeout in seconds for each reference link request")
+    parser.add_argument("--reference_ttl", type=float, default=24.0, help="Hours a cached reference page is used before it is revalidated")
+    parser.add_argument("--bypass_llm_cache", action="store_true", help="Always request new completions, but still store them in the cache")
+    parser.add_argument("--incremental", action="store_true", help="Checkpoint the run in the output folder and only process what changed since the previous run")
+    parser.add_argument("--stream", action="store_true", help="Stream completions and write each iteration file as its sections are generated")
+    parser.add_argument("--mirror_dir", type=str, default=".cache/mirrors", help="Folder for the bare git mirrors used by the git backend")
+    parser.add_argument("--manifest", type=str, default=None, help="JSON file listing several notebooks to generate in one run (see load_manifest)")
+    parser.add_argument("--jobs", type=int, default=2, help="Number of notebooks of the manifest generated concurrently")
+    parser.add_argument("--llm_batch", type=str, choices=["submit", "resume"], default=None, help="Defer the first-pass completions to a batch job (submit), then finish the notebooks from its results in a later run (resume); requires --cache_dir")
+    parser.add_argument("--llm_batch_backend", type=str, choices=["openai", "direct"], default="openai", help="Run the batch job with the Batch API or by sending its requests directly to the chat completions endpoint")
+    parser.add_argument("--trace_file", type=str, default=None, help="Record spans of the requests, completions and stages to this file (Chrome trace format) and print a summary")
+    parser.add_argument("--llm_batch_poll", type=float, default=60.0, help="Seconds between two status checks of the batch job when resuming")
     
     args = parser.parse_args()
+    if not args.manifest and not (args.repo_url and args.branch and args.metadata_file_path):
+        parser.error("--repo_url, --branch and --metadata_file_path are required without --manifest")
+    if args.llm_batch and (not args.cache_dir or args.bypass_llm_cache or args.stream):
+        parser.error("--llm_batch requires --cache_dir and cannot be combined with --bypass_llm_cache or --stream")
+    if args.incremental and not args.cache_dir and args.backend != "git":
+        # Only the cache keeps the diffs of the commits processed by the previous run
+        parser.error("--incremental requires --cache_dir (or --backend git)")
 
     # Use the provided token or fall back to the environment variable
     gh_token = args.gh_token or os.getenv("GITHUB_TOKEN")
@@ -297,47 +663,56 @@ def main():
         print("No commits or date range provided, defaulting to the current week's commits.")
         args.date_start, args.date_end = get_current_week_dates()  # Automatically set current week
     
-    # Load and validate reference links
-    reference_links = load_reference_links(args.reference_file_path)
-    check_reference_links(reference_links)
-    
-    # Validate metadata file
-    check_metadata_file(args.metadata_file_path)
+    if args.trace_file:
+        tracer.enable()
+
+    # A single notebook is a batch of one job
+    if args.manifest:
+        jobs = load_manifest(args.manifest)
+        for job in jobs:
+            job.setdefault("output_folder", os.path.join(args.output_folder, job["member"]))
+    else:
+        jobs = [{"repo_url": args.repo_url, "branch": args.branch, "member": args.repo_url, "metadata_file_path": args.metadata_file_path, "output_folder": args.output_folder}]
     
-    # Create the output folder if it doesn't exist
-    os.makedirs(args.output_folder, exist_ok=True)
-    
-    # Generate the notebook content
-    responses = notebook_pipeline(
-        checker_iterations=args.checker_iterations,
-        gh_token=gh_token,
-        repo_url=args.repo_url,
-        branch=args.branch,
-        commits=args.commits,
-        date_start=args.date_start,
-        date_end=args.date_end,
-        reference_links=reference_links,
-        metadata_file_path=args.metadata_file_path
-    )
+    # The reference links are fetched and validated by the pipeline next to the GitHub stage
+    reference_cache = ReferenceCache(args.cache_dir, ttl=args.reference_ttl * 3600) if args.cache_dir else None
+    reference_loader = ReferenceLoader(timeout=args.reference_timeout, cache=reference_cache)
+    github_client = create_github_client(gh_token, args.max_workers, args.cache_dir, args.backend, args.mirror_dir, args.api_url, pipelines=min(args.jobs, len(jobs)), timeout=args.github_timeout)
     
-    # Save each iteration response to a separate file
-    for i, (initial_response, checker_response, revised_response, answer) in enumerate(responses):
-        file_name = f"iteration_{i+1}.md"
-        file_path = os.path.join(args.output_folder, file_name)
-        
-        with open(file_path, 'w') as f:
-            f.write(f"# Iteration {i+1}\n\n")
-            f.write("## Initial Response\n")
-            f.write(initial_response + "\n\n")
-            f.write("## Checker Response\n")
-            f.write(checker_response + "\n\n")
-            f.write("## Revised Response\n")
-            f.write(revised_response + "\n\n")
-            f.write("## Asnwer to Notebook\n")
-            f.write(answer + "\n\n")
-
-        
-        print(f"Iteration {i+1} has been saved to {file_path}")
+    # Cache completions across runs
+    global completion_cache, batch_collector
+    completion_cache = CompletionCache(args.cache_dir, bypass=args.bypass_llm_cache) if args.cache_dir else None
+
+    # Deferred completions go through the cache: the batch results are stored under the keys the pipeline looks up
+    batch_dir = os.path.join(args.cache_dir, "llm_batch") if args.llm_batch else None
+    if batch_dir:
+        os.makedirs(batch_dir, exist_ok=True)
+        if args.llm_batch_backend == "openai":
+            batch_backend = OpenAIBatchBackend(get_openai_client())
+        else:
+            batch_backend = DirectBatchBackend(get_openai_client(), batch_dir, max_workers=args.summary_workers)
+    batch_collector = BatchCollector() if args.llm_batch == "submit" else None
+    if args.llm_batch == "resume":
+        collect_batch(batch_backend, batch_dir, completion_cache, poll_interval=args.llm_batch_poll)
+
+    if args.manifest:
+        errors = run_notebook_jobs(jobs, args, gh_token, github_client, reference_loader)
+    else:
+        run_notebook_job(jobs[0], args, gh_token, github_client, reference_loader)
+        errors = {}
+
+    if batch_collector and submit_batch(batch_collector, batch_backend, batch_dir):
+        print("Run again with --llm_batch resume to finish the notebooks once the batch is done.")
+
+    if completion_cache:
+        print(f"Completion cache: {completion_cache.stats()}")
+    if args.trace_file:
+        tracer.write(args.trace_file)
+        print(tracer.summary())
+        print(f"Trace saved to {args.trace_file}")
+    failed = [member for member, error in errors.items() if error]
+    if failed:
+        raise RuntimeError(f"Notebook generation failed for {', '.join(failed)}.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,163 @@
+import base64
+import os
+import subprocess
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Tuple
+from github_client import GithubClient
+
+# Separators for the `git log` format, they cannot appear in commit metadata
+FIELD_SEP = "\x1f"
+RECORD_SEP = "\x1e"
+
+
+class GitMirrorClient(GithubClient):
+    """
+    Alternative to the REST backend that keeps a bare clone of each repository under
+    mirror_dir and reads commits and diffs straight from git. The clone is created on
+    first use and updated incrementally with `git fetch` afterwards, so no request
+    counts against the GitHub rate limit. Besides GitHub URLs, gh_repo_url may also
+    be a local path or file:// URL, which allows running against a fixture repository.
+    """
+
+    def __init__(self, token: str, mirror_dir: str, max_workers: int = 8) -> None:
+        super().__init__(token, max_workers=max_workers)
+        self.mirror_dir = mirror_dir
+        self._synced = set()
+        # Several pipelines can share the client, each mirror is cloned or fetched by one of them
+        # at a time while other mirrors sync in parallel
+        self._sync_locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    @property
+    def lazy_diffs(self) -> bool:
+        # Patches are cheap to read back from the mirror
+        return True
+
+    def warm_diffs(self, gh_repo_url: str, shas: List[str]) -> None:
+        pass
+
+    def iter_commits(self, gh_repo_url: str, branch: str, num_commits: int = None, date_start: str = None, date_end: str = None) -> Iterator[Dict]:
+        mirror_path = self.sync_mirror(gh_repo_url)
+
+        args = ["log", branch, "--no-color", f"--format=%H{FIELD_SEP}%an{FIELD_SEP}%ae{FIELD_SEP}%ct{FIELD_SEP}%B{RECORD_SEP}"]
+        if num_commits:
+            args.append(f"--max-count={num_commits}")
+        # Same inclusive window as the REST backend, on the committer date
+        since, until = self.date_window(date_start, date_end)
+        if since:
+            args.append(f"--since={since}")
+        if until:
+            args.append(f"--until={until}")
+
+        output = self.run_git(mirror_path, *args)
+        for record in output.split(RECORD_SEP):
+            record = record.lstrip("\n")
+            if not record:
+                continue
+            sha, author_name, author_email, committed_ts, message = record.split(FIELD_SEP, 4)
+            committed_date = datetime.fromtimestamp(int(committed_ts), tz=timezone.utc)
+            # Same shape as an item of the REST commit listing
+            yield {
+                "sha": sha,
+                "commit": {
+                    "message": message.rstrip("\n"),
+                    "author": {"name": author_name, "email": author_email},
+                    "committer": {"date": committed_date.strftime("%Y-%m-%dT%H:%M:%SZ")},
+                },
+                "html_url": self.commit_url(gh_repo_url, sha),
+            }
+
+    def get_commit_diff(self, gh_repo_url: str, commit_sha: str) -> List[Dict[str, str]]:
+        mirror_path = self.sync_mirror(gh_repo_url)
+
+        # Numstat lines come first, followed by the patch of each file
+        output = self.run_git(
+            mirror_path, "-c", "core.quotePath=false", "show", commit_sha, "--format=", "--numstat", "--patch",
+            "--no-color", "--no-renames", "--no-ext-diff", "--diff-merges=first-parent"
+        )
+        lines = output.split("\n")
+        patch_start = next((i for i, line in enumerate(lines) if line.startswith("diff --git ")), len(lines))
+
+        stats = []
+        for line in lines[:patch_start]:
+            if not line.strip():
+                continue
+            additions, deletions, filename = line.split("\t", 2)
+            # Binary files report "-" for both counts
+            stats.append((filename, int(additions) if additions != "-" else 0, int(deletions) if deletions != "-" else 0))
+
+        # Mode-only changes have a patch header but no numstat line, so patches are matched by filename
+        patches = {}
+        current = None
+        for line in lines[patch_start:]:
+            if line.startswith("diff --git "):
+                # Without renames the header reads "diff --git a/<name> b/<name>"
+                paths = line[len("diff --git a/"):]
+                current = patches.setdefault(paths[:(len(paths) - len(" b/")) // 2], [])
+            elif current is not None and (current or line.startswith("@@")):
+                # Like the REST API, keep only the hunks and drop the file headers
+                current.append(line)
+
+        diffs = []
+        for filename, additions, deletions in stats:
+            patch = "\n".join(patches.get(filename, [])).rstrip("\n")
+            diffs.append({
+                "filename": filename,
+                "additions": additions,
+                "deletions": deletions,
+                "patch": patch or "No patch available"
+            })
+        return diffs
+
+    def sync_mirror(self, gh_repo_url: str) -> str:
+        """Creates the bare clone of a repository or fetches new commits into it, once per client."""
+        remote_url, mirror_name = self.resolve_remote(gh_repo_url)
+        mirror_path = os.path.join(self.mirror_dir, mirror_name)
+        with self._locks_lock:
+            sync_lock = self._sync_locks.setdefault(mirror_path, threading.Lock())
+        with sync_lock:
+            if mirror_path in self._synced:
+                return mirror_path
+
+            auth = self.auth_config(remote_url)
+            if not os.path.isdir(mirror_path):
+                os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+                self.run_git(None, *auth, "clone", "--bare", "--quiet", remote_url, mirror_path)
+            else:
+                self.run_git(mirror_path, *auth, "fetch", "--quiet", "--prune", remote_url, "+refs/heads/*:refs/heads/*")
+            self._synced.add(mirror_path)
+        return mirror_path
+
+    def resolve_remote(self, gh_repo_url: str) -> Tuple[str, str]:
+        """Returns the URL to clone from and the folder name of the mirror."""
+        try:
+            owner, repo_name = self.extract_owner_repo(gh_repo_url)
+        except ValueError:
+            # Local fixture repository
+            local_path = gh_repo_url[len("file://"):] if gh_repo_url.startswith("file://") else gh_repo_url
+            if not os.path.isdir(local_path):
+                raise ValueError(f"Invalid GitHub repository URL or local path: {gh_repo_url}")
+            return os.path.abspath(local_path), os.path.join("local", os.path.basename(os.path.abspath(local_path)) + ".git")
+        repo_name = repo_name[:-len(".git")] if repo_name.endswith(".git") else repo_name
+        return f"https://github.com/{owner}/{repo_name}.git", os.path.join(owner, f"{repo_name}.git")
+
+    def commit_url(self, gh_repo_url: str, sha: str) -> str:
+        remote_url, _ = self.resolve_remote(gh_repo_url)
+        if remote_url.startswith("https://github.com/"):
+            return f"{remote_url[:-len('.git')]}/commit/{sha}"
+        return f"{remote_url}@{sha}"
+
+    def auth_config(self, remote_url: str) -> List[str]:
+        # Pass the token as a one-off header so it is never written to the mirror's config
+        if not self.token or not remote_url.startswith("https://"):
+            return []
+        credentials = base64.b64encode(f"x-access-token:{self.token}".encode()).decode()
+        return ["-c", f"http.extraHeader=Authorization: Basic {credentials}"]
+
+    def run_git(self, git_dir: str, *args: str) -> str:
+        command = ["git"] + (["--git-dir", git_dir] if git_dir else []) + list(args)
+        result = subprocess.run(command, capture_output=True, text=True, encoding="utf-8", errors="replace")
+        if result.returncode != 0:
+            raise Exception(f"git command failed with exit code {result.returncode}\n{result.stderr}")
+        return result.stdout
@@ -0,0 +1,41 @@
+import json
+import zlib
+from typing import Any, Dict, Optional
+from sqlite_store import SqliteStore
+
+
+class CachedResponse:
+    def __init__(self, data: Any, etag: Optional[str], next_url: Optional[str]):
+        self.data = data
+        self.etag = etag
+        self.next_url = next_url
+
+
+class GithubCache(SqliteStore):
+    """
+    Persistent store for GitHub REST responses. Entries are keyed on the request URL plus
+    its query parameters and store the compressed JSON body, the ETag used for
+    `If-None-Match` revalidation and the `rel="next"` pagination link.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 512 * 1024 * 1024) -> None:
+        super().__init__(cache_dir, "github_cache.sqlite", "responses", ["etag", "next_url", "body"], max_bytes,
+                         ["hits", "revalidations", "misses"])
+
+    @staticmethod
+    def make_key(url: str, params: Optional[Dict[str, Any]] = None) -> str:
+        if not params:
+            return url
+        query = "&".join(f"{key}={params[key]}" for key in sorted(params))
+        return f"{url}?{query}"
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        row = self.get_row(key)
+        if row is None:
+            return None
+        etag, next_url, body = row
+        return CachedResponse(json.loads(zlib.decompress(body)), etag, next_url)
+
+    def put(self, key: str, data: Any, etag: Optional[str] = None, next_url: Optional[str] = None) -> None:
+        body = zlib.compress(json.dumps(data).encode("utf-8"))
+        self.put_row(key, (etag, next_url, body), len(body))
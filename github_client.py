@@ -1,20 +1,77 @@
 import requests
-from typing import Dict, List, Tuple
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
+from github_cache import GithubCache
+from request_scheduler import RequestScheduler
+from tracing import tracer
+
+# Commit objects addressed by a full SHA never change, so they are served from the cache without revalidation
+IMMUTABLE_COMMIT_PATTERN = re.compile(r"/commits/[0-9a-f]{40}$")
+
+# Commit history of a branch with the fields of the REST listing, 100 commits per query
+COMMIT_HISTORY_QUERY = """
+query($owner: String!, $name: String!, $branch: String!, $first: Int!, $after: String, $since: GitTimestamp, $until: GitTimestamp) {
+  repository(owner: $owner, name: $name) {
+    object(expression: $branch) {
+      ... on Commit {
+        history(first: $first, after: $after, since: $since, until: $until) {
+          pageInfo { hasNextPage endCursor }
+          nodes {
+            oid
+            message
+            url
+            committedDate
+            changedFilesIfAvailable
+            author { name email }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+# Commits listed when neither a count nor a date window is given (one page of the listing)
+DEFAULT_COMMIT_LIMIT = 100
+
+
+class GithubRequestError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"Request failed, status code {status_code}\n{message}")
+        self.status_code = status_code
+
 
 class GithubCommitResponse:
-    def __init__(self, message: str, committed_date: str, sha: str, author_name: str, author_email: str, url: str, diffs: List[Dict[str, str]]):
+    # Slots keep the per-commit overhead small, the patches themselves are only held
+    # when no loader is given, otherwise they are read back on demand
+    __slots__ = ("message", "committed_date", "sha", "author_name", "author_email", "url", "_diffs", "_load_diffs")
+
+    def __init__(self, message: str, committed_date: str, sha: str, author_name: str, author_email: str, url: str, diffs: Optional[List[Dict[str, str]]] = None, load_diffs: Optional[Callable[[], List[Dict[str, str]]]] = None):
         self.message = message
         self.committed_date = committed_date
         self.sha = sha
         self.author_name = author_name
         self.author_email = author_email
         self.url = url
-        self.diffs = diffs
+        self._diffs = diffs
+        self._load_diffs = load_diffs
+
+    @property
+    def diffs(self) -> List[Dict[str, str]]:
+        if self._diffs is not None:
+            return self._diffs
+        return self._load_diffs() if self._load_diffs else []
+
+    @diffs.setter
+    def diffs(self, diffs: List[Dict[str, str]]) -> None:
+        self._diffs = diffs
 
     @staticmethod
-    def from_dict(response_dict: dict, diffs: Dict[str, List[Dict[str, str]]]) -> List['GithubCommitResponse']:
+    def from_dict(response_dict: dict, diffs: Dict[str, List[Dict[str, str]]], diff_loader: Optional[Callable[[str], List[Dict[str, str]]]] = None) -> List['GithubCommitResponse']:
         commits = []
         for commit_data in response_dict:
             sha = commit_data['sha']
@@ -25,29 +82,110 @@ class GithubCommitResponse:
                 author_name=commit_data['commit']['author']['name'],
                 author_email=commit_data['commit']['author']['email'],
                 url=commit_data['html_url'],
-                diffs=diffs.get(sha, [])
+                diffs=diffs.get(sha, []) if sha in diffs or not diff_loader or commit_data.get('changed_files') == 0 else None,
+                load_diffs=(lambda sha=sha: diff_loader(sha)) if diff_loader else None
             )
             commits.append(commit)
         return commits
 
+    def iter_text(self) -> Iterator[str]:
+        """Yields the same text as repr() piece by piece, one file diff at a time."""
+        yield (f"Commit({self.sha[:7]}): {self.message}\n"
+               f"Author: {self.author_name} <{self.author_email}>\n"
+               f"Date: {self.committed_date}\n"
+               f"URL: {self.url}\n"
+               f"Diffs:\n")
+        for i, diff in enumerate(self.diffs):
+            yield ("\n\n" if i else "") + f"File: {diff['filename']} - Additions: {diff['additions']}, Deletions: {diff['deletions']}\nPatch:\n"
+            yield diff['patch']
+        yield "\n"
+
     def __repr__(self):
-        diffs_str = "\n\n".join(
-            [f"File: {diff['filename']} - Additions: {diff['additions']}, Deletions: {diff['deletions']}\nPatch:\n{diff['patch']}"
-             for diff in self.diffs]
-        )
-        return (f"Commit({self.sha[:7]}): {self.message}\n"
-                f"Author: {self.author_name} <{self.author_email}>\n"
-                f"Date: {self.committed_date}\n"
-                f"URL: {self.url}\n"
-                f"Diffs:\n{diffs_str}\n")
+        return "".join(self.iter_text())
 
 
 class GithubClient:
-    def __init__(self, token: str) -> None:
-        self.base_url = "https://api.github.com"
+    def __init__(self, token: str, max_workers: int = 8, cache: Optional[GithubCache] = None, scheduler: Optional[RequestScheduler] = None, use_graphql: bool = False, base_url: str = "https://api.github.com", pool_size: Optional[int] = None, timeout: float = 30.0) -> None:
+        self.base_url = base_url.rstrip("/")
+        # GitHub Enterprise serves REST under /api/v3 and GraphQL under /api/graphql,
+        # github.com and other bases serve GraphQL next to REST
+        self.graphql_url = (self.base_url[:-len("/v3")] if self.base_url.endswith("/api/v3") else self.base_url) + "/graphql"
         self.token = token
+        # Seconds to wait for each request, a stalled connection is then retried by the scheduler
+        self.timeout = timeout
+        # List commits with batched GraphQL queries, diffs still come from REST
+        self.use_graphql = use_graphql
+        self.cache = cache
+        # Retries and rate-limit pacing, pass a shared scheduler to split one budget between clients
+        self.scheduler = scheduler or RequestScheduler()
+        # Number of commit diffs fetched concurrently (1 fetches them serially)
+        self.max_workers = max(1, max_workers)
+
+        # Shared keep-alive session, with a connection pool large enough for every worker
+        # (pool_size is larger when several pipelines share the client)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size or 0, self.max_workers))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {self.token}",
+            "Accept": "application/vnd.github.v3+json"
+        })
 
     def get_commits_and_diffs(self, gh_repo_url: str, branch: str, num_commits: int = None, date_start: str = None, date_end: str = None) -> List[GithubCommitResponse]:
+        # Filter by date range if num_commits is not specified
+        if num_commits or not (date_start and date_end):
+            date_start, date_end = None, None
+        # Without a count or a window, only the latest commits rather than the whole history
+        if not num_commits and not date_start:
+            num_commits = DEFAULT_COMMIT_LIMIT
+
+        # Collect the commits by following every page of the listing
+        if self.use_graphql:
+            response = list(self.iter_commits_graphql(gh_repo_url, branch, num_commits, date_start, date_end))
+        else:
+            response = list(self.iter_commits(gh_repo_url, branch, num_commits, date_start, date_end))
+
+        # GraphQL reports the number of changed files, commits without any need no diff request
+        shas = [commit_data['sha'] for commit_data in response if commit_data.get('changed_files') != 0]
+
+        if self.lazy_diffs:
+            # Only warm the source, each commit reads its patches back when it is serialized
+            self.warm_diffs(gh_repo_url, shas)
+            return GithubCommitResponse.from_dict(response, {}, lambda sha: self.get_commit_diff(gh_repo_url, sha))
+
+        # Fetch diffs for each commit concurrently, map() keeps the commit order
+        diffs = dict(zip(shas, self.map_diffs(gh_repo_url, shas)))
+
+        # Convert the dictionary to a list of GithubCommitResponse objects with diffs
+        commits_with_diffs = GithubCommitResponse.from_dict(response, diffs)
+        return commits_with_diffs
+
+    @property
+    def lazy_diffs(self) -> bool:
+        # Patches are only worth dropping from memory when they can be read back without a request
+        return self.cache is not None
+
+    def map_diffs(self, gh_repo_url: str, shas: List[str]) -> Iterator[List[Dict[str, str]]]:
+        if self.max_workers > 1 and len(shas) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(shas))) as executor:
+                yield from executor.map(lambda sha: self.get_commit_diff(gh_repo_url, sha), shas)
+        else:
+            for sha in shas:
+                yield self.get_commit_diff(gh_repo_url, sha)
+
+    def warm_diffs(self, gh_repo_url: str, shas: List[str]) -> None:
+        # Results are dropped as they arrive, the cache keeps them
+        for _ in self.map_diffs(gh_repo_url, shas):
+            pass
+
+    def iter_commits(self, gh_repo_url: str, branch: str, num_commits: int = None, date_start: str = None, date_end: str = None) -> Iterator[Dict]:
+        """
+        Yields the raw commit listing of a branch, newest first, following the
+        `Link: rel="next"` headers until num_commits are yielded or the listing
+        moves past date_start. Both dates are inclusive and sent to the API as
+        `since`/`until` so only the requested window is downloaded.
+        """
         # Extract owner and repository name using regex
         owner, repo_name = self.extract_owner_repo(gh_repo_url)
 
@@ -55,27 +193,97 @@ class GithubClient:
         url = f"{self.base_url}/repos/{owner}/{repo_name}/commits"
         params = {
             "sha": branch,
-            "per_page": num_commits if num_commits else 100,  # Max per page is 100
+            "per_page": min(num_commits, 100) if num_commits else 100,  # Max per page is 100
         }
 
-        # Execute the request to get commits
-        response = self.run_rest_request(url, params)
+        since, until = self.date_window(date_start, date_end)
+        if since:
+            params["since"] = since
+        if until:
+            params["until"] = until
 
-        # Filter by date range if num_commits is not specified
-        if not num_commits and date_start and date_end:
-            date_start_dt = datetime.strptime(date_start, "%Y-%m-%d")
-            date_end_dt = datetime.strptime(date_end, "%Y-%m-%d")
-            response = [commit for commit in response if date_start_dt <= datetime.strptime(commit['commit']['committer']['date'], "%Y-%m-%dT%H:%M:%SZ") <= date_end_dt]
-
-        # Fetch diffs for each commit
-        diffs = {}
-        for commit_data in response:
-            sha = commit_data['sha']
-            diffs[sha] = self.get_commit_diff(gh_repo_url, sha)
+        def pages(url: Optional[str], params: Optional[Dict]) -> Iterator[List[Dict]]:
+            while url:
+                # Execute the request to get one page of commits
+                page, next_url = self.run_paged_request(url, params)
+                yield page
 
-        # Convert the dictionary to a list of GithubCommitResponse objects with diffs
-        commits_with_diffs = GithubCommitResponse.from_dict(response, diffs)
-        return commits_with_diffs
+                # The next page URL already carries the query string
+                url = next_url
+                params = None
+
+        yield from self.filter_commit_pages(pages(url, params), num_commits, since, until)
+
+    def iter_commits_graphql(self, gh_repo_url: str, branch: str, num_commits: int = None, date_start: str = None, date_end: str = None) -> Iterator[Dict]:
+        """
+        Same listing as iter_commits, read through the GraphQL commit history so a whole
+        week comes back in a few queries. Each commit also carries `changed_files`.
+        """
+        owner, repo_name = self.extract_owner_repo(gh_repo_url)
+        since, until = self.date_window(date_start, date_end)
+        variables = {
+            "owner": owner,
+            "name": repo_name,
+            "branch": branch,
+            "first": min(num_commits, 100) if num_commits else 100,
+            "after": None,
+            "since": since,
+            "until": until,
+        }
+
+        def pages() -> Iterator[List[Dict]]:
+            while True:
+                data = self.run_graphql_request(COMMIT_HISTORY_QUERY, variables)
+                target = (data.get("repository") or {}).get("object")
+                if not target:
+                    raise ValueError(f"Branch {branch} not found in {gh_repo_url}")
+                history = target["history"]
+                # Reshape the nodes into items of the REST commit listing, the author of a commit
+                # is null when GitHub cannot resolve its git actor
+                yield [
+                    {
+                        "sha": node["oid"],
+                        "commit": {
+                            "message": node["message"],
+                            "author": {"name": (node["author"] or {}).get("name") or "Unknown", "email": (node["author"] or {}).get("email") or ""},
+                            "committer": {"date": node["committedDate"]},
+                        },
+                        "html_url": node["url"],
+                        "changed_files": node["changedFilesIfAvailable"],
+                    }
+                    for node in history["nodes"]
+                ]
+                if not history["pageInfo"]["hasNextPage"]:
+                    return
+                variables["after"] = history["pageInfo"]["endCursor"]
+
+        yield from self.filter_commit_pages(pages(), num_commits, since, until)
+
+    @staticmethod
+    def date_window(date_start: str = None, date_end: str = None) -> Tuple[Optional[str], Optional[str]]:
+        """Converts the inclusive YYYY-MM-DD range into the `since`/`until` timestamps of the API."""
+        since = datetime.strptime(date_start, "%Y-%m-%d").strftime("%Y-%m-%dT%H:%M:%SZ") if date_start else None
+        until = None
+        if date_end:
+            until = (datetime.strptime(date_end, "%Y-%m-%d") + timedelta(days=1) - timedelta(seconds=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        return since, until
+
+    @staticmethod
+    def filter_commit_pages(pages: Iterator[List[Dict]], num_commits: int = None, since: str = None, until: str = None) -> Iterator[Dict]:
+        # Timestamps in the same format compare correctly as strings
+        yielded = 0
+        for page in pages:
+            for commit in page:
+                committed_date = commit['commit']['committer']['date']
+                if since and committed_date < since:
+                    # The listing is newest first, everything after this is older
+                    return
+                if until and committed_date > until:
+                    continue
+                yield commit
+                yielded += 1
+                if num_commits and yielded >= num_commits:
+                    return
 
     def get_commit_diff(self, gh_repo_url: str, commit_sha: str) -> List[Dict[str, str]]:
         # Extract owner and repository name using regex
@@ -116,23 +324,65 @@ class GithubClient:
             raise ValueError("Invalid GitHub repository URL")
 
     def run_rest_request(self, url: str, params: Dict[str, str] = None) -> Dict:
-        # Set up the request headers
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Accept": "application/vnd.github.v3+json"
-        }
+        # Return the JSON response
+        data, _ = self.run_paged_request(url, params)
+        return data
 
-        # Make the request to the GitHub REST API
-        response = requests.get(url, headers=headers, params=params)
+    def run_paged_request(self, url: str, params: Dict[str, str] = None) -> Tuple[Any, Optional[str]]:
+        """
+        Returns the decoded JSON body and the `rel="next"` link of a request,
+        going through the cache when one is configured.
+        """
+        with tracer.span("github_request", url=url) as span:
+            if self.cache is None:
+                response = self.send_rest_request(url, params)
+                span.set(bytes=len(response.content))
+                return response.json(), response.links.get("next", {}).get("url")
 
-        # Check for errors
+            key = GithubCache.make_key(url, params)
+            cached = self.cache.get(key)
+            if cached is not None and IMMUTABLE_COMMIT_PATTERN.search(url):
+                self.cache.record("hits")
+                span.set(cache="hit")
+                return cached.data, cached.next_url
+
+            # Revalidate list endpoints, a 304 does not count against the rate limit
+            headers = {"If-None-Match": cached.etag} if cached is not None and cached.etag else None
+            response = self.send_rest_request(url, params, headers)
+            if response.status_code == 304:
+                self.cache.record("revalidations")
+                span.set(cache="revalidated")
+                return cached.data, cached.next_url
+
+            self.cache.record("misses")
+            span.set(cache="miss", bytes=len(response.content))
+            data = response.json()
+            next_url = response.links.get("next", {}).get("url")
+            self.cache.put(key, data, response.headers.get("ETag"), next_url)
+            return data, next_url
+
+    def run_graphql_request(self, query: str, variables: Dict[str, Any]) -> Dict:
+        with tracer.span("github_graphql") as span:
+            response = self.scheduler.send(lambda: self.session.post(self.graphql_url, json={"query": query, "variables": variables}, timeout=self.timeout))
+            span.set(bytes=len(response.content))
         if response.status_code != 200:
-            raise Exception(
-                f"Request failed, status code {response.status_code}\n{response.text}"
-            )
+            raise GithubRequestError(response.status_code, response.text)
 
-        # Return the JSON response
-        return response.json()
+        # GraphQL reports query errors with a 200 status
+        body = response.json()
+        if body.get("errors"):
+            raise GithubRequestError(response.status_code, str(body["errors"]))
+        return body["data"]
+
+    def send_rest_request(self, url: str, params: Dict[str, str] = None, headers: Dict[str, str] = None) -> requests.Response:
+        # Make the request to the GitHub REST API over the shared session, retrying transient failures
+        response = self.scheduler.send(lambda: self.session.get(url, params=params, headers=headers, timeout=self.timeout))
+
+        # Check for errors
+        if response.status_code not in (200, 304):
+            raise GithubRequestError(response.status_code, response.text)
+
+        return response
 
 
 if __name__ == "__main__":
@@ -0,0 +1,184 @@
+import json
+from abc import ABC, abstractmethod
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from completion_cache import CompletionCache
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_JOB_FILE = "llm_batch_job.json"
+
+
+class DeferredCompletion(Exception):
+    """Raised instead of a completion whose request was added to the batch job."""
+
+    def __init__(self, key: str) -> None:
+        super().__init__(f"Completion {key[:12]} deferred to the LLM batch")
+        self.key = key
+
+
+class BatchCollector:
+    """
+    Collects the chat completion requests of a run, keyed on their completion cache key,
+    into the JSONL input of a batch job (one request per line, in the format of the OpenAI
+    Batch API). Identical prompts from several notebooks become a single request.
+    """
+
+    def __init__(self) -> None:
+        self.requests: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, key: str, model: str, messages: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self.requests.setdefault(key, {
+                "custom_id": key,
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": {"model": model, "messages": messages},
+            })
+
+    def write(self, file_path: str) -> int:
+        with self._lock:
+            with open(file_path, 'w') as f:
+                for request in self.requests.values():
+                    f.write(json.dumps(request) + "\n")
+            return len(self.requests)
+
+
+class BatchBackend(ABC):
+    """
+    Submit/poll layer of the batch jobs. submit() uploads a JSONL file of requests and returns
+    the batch id, status() returns "completed" once the results are ready (or "failed",
+    "expired", "cancelled"), and results() returns the output lines in the Batch API format.
+    """
+
+    @abstractmethod
+    def submit(self, requests_file: str) -> str:
+        ...
+
+    @abstractmethod
+    def status(self, batch_id: str) -> str:
+        ...
+
+    @abstractmethod
+    def results(self, batch_id: str) -> List[Dict[str, Any]]:
+        ...
+
+
+class OpenAIBatchBackend(BatchBackend):
+    """Runs the job with the OpenAI Batch API, or any server implementing /files and /batches (see OPENAI_BASE_URL)."""
+
+    def __init__(self, client) -> None:
+        self.client = client
+
+    def submit(self, requests_file: str) -> str:
+        with open(requests_file, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window="24h")
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id: str) -> List[Dict[str, Any]]:
+        batch = self.client.batches.retrieve(batch_id)
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                lines.extend(json.loads(line) for line in self.client.files.content(file_id).text.splitlines() if line.strip())
+        return lines
+
+
+class DirectBatchBackend(BatchBackend):
+    """
+    Stand-in for servers without a batch API: submit() sends every request to the regular chat
+    completions endpoint right away, max_workers at a time, and keeps the output lines in
+    batch_dir until they are collected.
+    """
+
+    def __init__(self, client, batch_dir: str, max_workers: int = 4) -> None:
+        self.client = client
+        self.batch_dir = batch_dir
+        self.max_workers = max(1, max_workers)
+
+    def submit(self, requests_file: str) -> str:
+        with open(requests_file, 'r') as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+
+        def run(request: Dict[str, Any]) -> Dict[str, Any]:
+            try:
+                response = self.client.chat.completions.create(**request["body"])
+                return {"custom_id": request["custom_id"], "response": {"status_code": 200, "body": response.model_dump()}, "error": None}
+            except Exception as e:
+                return {"custom_id": request["custom_id"], "response": None, "error": {"message": str(e)}}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            lines = list(executor.map(run, requests))
+        batch_id = f"direct_{uuid.uuid4().hex}"
+        with open(os.path.join(self.batch_dir, f"{batch_id}.jsonl"), 'w') as f:
+            for line in lines:
+                f.write(json.dumps(line) + "\n")
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        return "completed" if os.path.isfile(os.path.join(self.batch_dir, f"{batch_id}.jsonl")) else "failed"
+
+    def results(self, batch_id: str) -> List[Dict[str, Any]]:
+        with open(os.path.join(self.batch_dir, f"{batch_id}.jsonl"), 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+def submit_batch(collector: BatchCollector, backend: BatchBackend, batch_dir: str) -> Optional[str]:
+    """Writes and submits the collected requests, and records the job in batch_dir so a later run can resume it."""
+    os.makedirs(batch_dir, exist_ok=True)
+    requests_file = os.path.join(batch_dir, "llm_batch_requests.jsonl")
+    count = collector.write(requests_file)
+    if not count:
+        return None
+    batch_id = backend.submit(requests_file)
+    with open(os.path.join(batch_dir, BATCH_JOB_FILE), 'w') as f:
+        json.dump({"batch_id": batch_id, "requests": count, "submitted_at": time.time()}, f)
+    print(f"Submitted LLM batch {batch_id} with {count} request(s).")
+    return batch_id
+
+
+def collect_batch(backend: BatchBackend, batch_dir: str, cache: CompletionCache, poll_interval: float = 60.0, timeout: Optional[float] = None) -> int:
+    """
+    Waits for the submitted job to complete, then stores its completions in the cache, where
+    the resumed pipeline finds them under the same keys. Returns the number of completions.
+    """
+    job_path = os.path.join(batch_dir, BATCH_JOB_FILE)
+    if not os.path.isfile(job_path):
+        raise FileNotFoundError(f"No submitted LLM batch found in {batch_dir}.")
+    with open(job_path, 'r') as f:
+        batch_id = json.load(f)["batch_id"]
+
+    start = time.time()
+    while True:
+        status = backend.status(batch_id)
+        if status == "completed":
+            break
+        if status in ("failed", "expired", "cancelled"):
+            raise RuntimeError(f"LLM batch {batch_id} ended with status {status}.")
+        if timeout is not None and time.time() - start > timeout:
+            raise TimeoutError(f"LLM batch {batch_id} is still {status} after {timeout:.0f}s.")
+        print(f"LLM batch {batch_id} is {status}, checking again in {poll_interval:.0f}s.")
+        time.sleep(poll_interval)
+
+    stored = 0
+    for line in backend.results(batch_id):
+        response = line.get("response") or {}
+        if line.get("error") or response.get("status_code") != 200:
+            # Left out of the cache, the resumed pipeline requests it directly
+            print(f"LLM batch request {line.get('custom_id', '')[:12]} failed: {line.get('error') or response.get('status_code')}")
+            continue
+        content = response["body"]["choices"][0]["message"]["content"]
+        if content is not None:
+            cache.put(line["custom_id"], content)
+            stored += 1
+    os.remove(job_path)
+    print(f"Collected {stored} completion(s) from LLM batch {batch_id}.")
+    return stored
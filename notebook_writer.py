@@ -0,0 +1,69 @@
+import os
+import re
+import threading
+from typing import Dict, TextIO, Tuple
+
+SECTION_TITLES = ["Initial Response", "Checker Response", "Revised Response", "Asnwer to Notebook"]
+
+
+def iteration_file_path(output_folder: str, index: int) -> str:
+    return os.path.join(output_folder, f"iteration_{index+1}.md")
+
+
+def write_iteration_file(output_folder: str, index: int, responses: Tuple[str, str, str, str]) -> str:
+    """Writes a whole iteration file through a temporary file, so it is either complete or absent."""
+    file_path = iteration_file_path(output_folder, index)
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(f"# Iteration {index+1}\n\n")
+        for title, text in zip(SECTION_TITLES, responses):
+            f.write(f"## {title}\n")
+            f.write(text + "\n\n")
+    os.replace(tmp_path, file_path)
+    return file_path
+
+
+def remove_stale_iteration_files(output_folder: str, count: int) -> None:
+    """Removes the iteration files (and leftover temporary files) numbered past count, left by an earlier run with more iterations."""
+    for name in os.listdir(output_folder):
+        match = re.fullmatch(r"iteration_(\d+)\.md(\.tmp)?", name)
+        if match and int(match.group(1)) > count:
+            os.remove(os.path.join(output_folder, name))
+
+
+class IterationStreamWriter:
+    """
+    Writes the iteration files while their completions stream in. Each file is written to
+    `iteration_N.md.tmp` section by section, line buffered so progress is visible right
+    away, and renamed to `iteration_N.md` once its last section is complete. The sections
+    of one file are produced one after the other by the checker rounds, so each file only
+    ever has one section open.
+    """
+
+    def __init__(self, output_folder: str) -> None:
+        self.output_folder = output_folder
+        self._files: Dict[int, TextIO] = {}
+        self._lock = threading.Lock()
+
+    def begin_section(self, index: int, title: str) -> None:
+        with self._lock:
+            if index not in self._files:
+                f = open(iteration_file_path(self.output_folder, index) + ".tmp", 'w', buffering=1)
+                f.write(f"# Iteration {index+1}\n\n")
+                self._files[index] = f
+            self._files[index].write(f"## {title}\n")
+
+    def write(self, index: int, text: str) -> None:
+        with self._lock:
+            self._files[index].write(text)
+
+    def end_section(self, index: int) -> None:
+        self.write(index, "\n\n")
+
+    def finish(self, index: int) -> None:
+        with self._lock:
+            f = self._files.pop(index)
+            f.close()
+            file_path = iteration_file_path(self.output_folder, index)
+            os.replace(file_path + ".tmp", file_path)
+        print(f"Iteration {index+1} has been saved to {file_path}")
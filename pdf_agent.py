@@ -3,62 +3,325 @@ import chromadb
 from tqdm import tqdm
 from agent import Prompt
 from PyPDF2 import PdfReader
+from token_count import count_tokens
+from tracing import tracer
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict, deque
+from typing import Dict, Iterator, List, Optional, Tuple
+import hashlib
 import json
+import os
+import re
+import threading
+import time
 
-def create_collection(collection_name: str, database_path: str, pdf_file: str):
-    client = chromadb.PersistentClient(path=database_path)
-    collection = client.create_collection(collection_name)
-    reader = PdfReader(pdf_file)
-    num_pages = len(reader.pages)
-    for i in tqdm(range(num_pages)):
-        collection.add(
-            documents=[reader.pages[i].extract_text()], 
-            metadatas=[{"source": "laamps_documentation", 'page': i}],  # filter on these!
-            ids=[f"laamps_page:${i}"],  # unique for each doc
-        )
+# PdfReader of the current worker process, so each worker parses the PDF structure only once
+_worker_readers: Dict[str, PdfReader] = {}
+
+def extract_page_range(pdf_file: str, start: int, end: int) -> List[Tuple[int, str]]:
+    if pdf_file not in _worker_readers:
+        _worker_readers[pdf_file] = PdfReader(pdf_file)
+    reader = _worker_readers[pdf_file]
+    return [(i, reader.pages[i].extract_text()) for i in range(start, end)]
+
+def iter_page_texts(pdf_file: str, num_pages: int, workers: Optional[int] = None, pages_per_task: int = 16) -> Iterator[Tuple[int, str]]:
+    """
+    Yields (page number, text) in page order, extracting ranges of pages in a process pool.
+    Only a couple of ranges per worker are in flight at a time, so memory stays bounded
+    no matter how large the PDF is.
+    """
+    workers = workers or os.cpu_count() or 1
+    ranges = iter([(start, min(start + pages_per_task, num_pages)) for start in range(0, num_pages, pages_per_task)])
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for start, end in ranges:
+            in_flight.append(executor.submit(extract_page_range, pdf_file, start, end))
+            if len(in_flight) >= workers * 2:
+                break
+        while in_flight:
+            yield from in_flight.popleft().result()
+            next_range = next(ranges, None)
+            if next_range:
+                in_flight.append(executor.submit(extract_page_range, pdf_file, *next_range))
+
+WORD_PATTERN = re.compile(r"\S+")
+SENTENCE_PATTERN = re.compile(r"[^.!?]+(?:[.!?]+|$)")
+
+def chunk_text(text: str, chunk_size: int = 200, overlap: int = 40, unit: str = "words") -> List[Tuple[int, int]]:
+    """
+    Splits text into overlapping chunks of chunk_size units ("words", roughly tokens, or
+    "sentences"), each sharing overlap units with the previous one. Returns the (start, end)
+    character offsets of the chunks, so the text and its position can be kept for citations.
+    """
+    pattern = WORD_PATTERN if unit == "words" else SENTENCE_PATTERN
+    spans = [match.span() for match in pattern.finditer(text) if match.group().strip()]
+    if not spans:
+        return []
+    step = max(1, chunk_size - overlap)
+    chunks = []
+    for first in range(0, len(spans), step):
+        last = min(first + chunk_size, len(spans)) - 1
+        chunks.append((spans[first][0], spans[last][1]))
+        if last == len(spans) - 1:
+            break
+    return chunks
+
+def source_name(pdf_file: str) -> str:
+    return os.path.splitext(os.path.basename(pdf_file))[0]
+
+def existing_hashes(collection, source: str, page_size: int = 5000) -> Dict[str, str]:
+    """Content hash of every chunk of a source already in the collection, by id."""
+    hashes = {}
+    offset = 0
+    while True:
+        existing = collection.get(where={"source": source}, include=["metadatas"], limit=page_size, offset=offset)
+        for chunk_id, metadata in zip(existing['ids'], existing['metadatas']):
+            hashes[chunk_id] = (metadata or {}).get('content_hash', "")
+        if len(existing['ids']) < page_size:
+            return hashes
+        offset += page_size
 
-def chroma_query(collection_name: str, database_path: str, query: str, n_results: int):
+# Source of the whole-page documents (ids "laamps_page:$i") indexed before pages were chunked
+LEGACY_SOURCE = "laamps_documentation"
+
+def delete_legacy_pages(collection, batch_size: int) -> int:
+    """Deletes the whole-page documents of the old index, which no source name of the chunked index matches."""
+    existing = collection.get(where={"source": LEGACY_SOURCE}, include=["metadatas"])
+    # Chunks of a PDF indexed under the same source name carry a content hash and are kept
+    legacy_ids = [chunk_id for chunk_id, metadata in zip(existing['ids'], existing['metadatas']) if 'content_hash' not in (metadata or {})]
+    for batch_start in range(0, len(legacy_ids), batch_size):
+        collection.delete(ids=legacy_ids[batch_start:batch_start + batch_size])
+    return len(legacy_ids)
+
+def create_collection(collection_name: str, database_path: str, pdf_files: List[str], sources: Optional[List[str]] = None, batch_size: int = 256, workers: Optional[int] = None, chunk_size: int = 200, chunk_overlap: int = 40, chunk_unit: str = "words", embedding_function=None):
+    """
+    Creates the collection or brings it up to date with the given PDFs. Every chunk is keyed
+    on its source, page and chunk index and stores a hash of its content, so only chunks whose
+    text changed are re-embedded (with upsert), chunks that disappeared from a source are
+    deleted, and running it twice on the same files does nothing. Several PDFs can share one
+    collection, each under its own source name (the file name unless sources are given).
+    embedding_function replaces Chroma's default embedding model when given. Whole-page
+    documents of the old index format are deleted.
+    """
     client = chromadb.PersistentClient(path=database_path)
-    collection = client.get_collection(collection_name)
+    collection = client.get_or_create_collection(collection_name, **({"embedding_function": embedding_function} if embedding_function else {}))
+    sources = sources or [source_name(pdf_file) for pdf_file in pdf_files]
+    if len(sources) != len(pdf_files):
+        raise ValueError("Expected one source name per PDF file")
+    # Chroma rejects batches over its own limit
+    batch_size = min(batch_size, client.get_max_batch_size())
+    # A collection built before chunking would otherwise mix its whole pages into every query
+    legacy = delete_legacy_pages(collection, batch_size)
+    if legacy:
+        print(f"Deleted {legacy} whole-page documents left by the previous index format.")
+
+    for pdf_file, source in zip(pdf_files, sources):
+        num_pages = len(PdfReader(pdf_file).pages)
+        stale = existing_hashes(collection, source)
+        counts = {"added": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+
+        start = time.perf_counter()
+        documents, metadatas, ids = [], [], []
+        for i, text in tqdm(iter_page_texts(pdf_file, num_pages, workers), total=num_pages, desc=source):
+            # Several small passages per page, with their page and character offsets for citations
+            for j, (chunk_start, chunk_end) in enumerate(chunk_text(text, chunk_size, chunk_overlap, chunk_unit)):
+                chunk_id = f"{source}:page:{i}:{j}"  # unique for each doc
+                document = text[chunk_start:chunk_end]
+                content_hash = hashlib.sha256(f"{chunk_start}:{document}".encode("utf-8")).hexdigest()
+                previous_hash = stale.pop(chunk_id, None)
+                if previous_hash == content_hash:
+                    counts["unchanged"] += 1
+                    continue
+                counts["added" if previous_hash is None else "updated"] += 1
+                documents.append(document)
+                metadatas.append({"source": source, 'page': i, 'chunk': j, 'start': chunk_start, 'end': chunk_end, 'content_hash': content_hash})  # filter on these!
+                ids.append(chunk_id)
+            # One embedding and persistence round trip per batch instead of per page, a page with
+            # many chunks can fill more than one
+            while len(documents) >= batch_size:
+                collection.upsert(documents=documents[:batch_size], metadatas=metadatas[:batch_size], ids=ids[:batch_size])
+                documents, metadatas, ids = documents[batch_size:], metadatas[batch_size:], ids[batch_size:]
+        if documents:
+            collection.upsert(documents=documents, metadatas=metadatas, ids=ids)
+
+        # Whatever was not seen again is gone from the document
+        stale_ids = list(stale)
+        for batch_start in range(0, len(stale_ids), batch_size):
+            collection.delete(ids=stale_ids[batch_start:batch_start + batch_size])
+        counts["deleted"] = len(stale_ids)
+
+        elapsed = time.perf_counter() - start
+        print(f"Ingested {num_pages} pages of {source} in {elapsed:.1f}s ({num_pages / elapsed if elapsed else 0:.1f} pages/sec): "
+              + ", ".join(f"{count} {name}" for name, count in counts.items()))
+
+def chroma_query(collection, query: str, n_results: int):
     results = collection.query(
         query_texts=[query],  # Chroma will embed this for you
         n_results=n_results  # how many results to return
     )
     return results
 
+class ChromaSearch:
+    """
+    Holds one Chroma client and collection handle for a whole agent session, so the index is
+    loaded from disk once instead of on every tool call. Results are kept in an LRU cache keyed
+    on the normalized query (case and whitespace folded) and n_results, and the latency of
+    every query is recorded.
+    """
+
+    def __init__(self, collection_name: str, database_path: str, cache_size: int = 128) -> None:
+        self.client = chromadb.PersistentClient(path=database_path)
+        self.collection = self.client.get_collection(collection_name)
+        self.cache_size = cache_size
+        self._results: "OrderedDict[Tuple[str, int], dict]" = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0}
+        self.latencies: List[float] = []
+        # Tool calls of one turn query concurrently
+        self._lock = threading.Lock()
+
+    def query(self, query: str, n_results: int) -> dict:
+        start = time.perf_counter()
+        key = (" ".join(query.lower().split()), n_results)
+        with tracer.span("chroma_query", n_results=n_results) as span:
+            with self._lock:
+                results = self._results.get(key)
+                if results is not None:
+                    self._results.move_to_end(key)
+                    self.counters["hits"] += 1
+                else:
+                    self.counters["misses"] += 1
+            span.set(cache="hit" if results is not None else "miss")
+            if results is None:
+                results = chroma_query(self.collection, query, n_results)
+                with self._lock:
+                    self._results[key] = results
+                    if len(self._results) > self.cache_size:
+                        self._results.popitem(last=False)
+            if span.recording:
+                span.set(tokens_in=count_tokens(query), tokens_out=sum(count_tokens(document) for document in results['documents'][0]))
+        with self._lock:
+            self.latencies.append(time.perf_counter() - start)
+        return results
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            latencies = sorted(self.latencies)
+            counters = dict(self.counters)
+        return {
+            **counters,
+            "queries": len(latencies),
+            "mean_ms": 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+            "p95_ms": 1000 * latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0,
+        }
+
 def additional_processing(function_result: dict):
     # Initialize an empty string to accumulate the formatted results
     processed_result = ""
     
     # Iterate over the list of documents
     for i in range(len(function_result['documents'][0])):
-        # Extract page number from metadata if available
-        page_info = function_result['metadatas'][0][i].get("page", "Unknown page")  # Assume metadata contains 'page' key
+        # Extract page number and passage offsets from metadata if available
+        metadata = function_result['metadatas'][0][i]
+        page_info = metadata.get("page", "Unknown page")  # Assume metadata contains 'page' key
         text = function_result['documents'][0][i]  # Assume the document contains 'text' key
+        offsets = f", chars {metadata['start']}-{metadata['end']}" if 'start' in metadata else ""
+        source = f"{metadata['source']}, " if 'source' in metadata else ""
         
         # Format each document into a string
-        processed_result += f"Result {i+1}, Page {page_info}:\n{text}\n\n"
+        processed_result += f"Result {i+1}, {source}Page {page_info}{offsets}:\n{text}\n\n"
     
     # Return the accumulated string
     return processed_result
 
-def execute_function(function_name: str, parameters: dict, hard_coded_params: dict):
+def message_tokens(message: dict) -> int:
+    tokens = 4 + count_tokens(message.get("content") or "")
+    for tool_call in message.get("tool_calls", []):
+        tokens += count_tokens(tool_call["function"]["name"] + tool_call["function"]["arguments"])
+    return tokens
+
+class ConversationWindow:
+    """
+    Keeps the messages sent to the model under token_budget. The conversation is stored as
+    turns (the user message, the assistant tool calls and their outputs, and the answer).
+    Tool outputs are only sent in full for the latest turn, older ones are replaced by a
+    short placeholder, and the oldest turns are evicted whole once the budget is exceeded,
+    so tool calls are never separated from their outputs. The cost of a turn therefore
+    stays flat however long the session runs.
+    """
+
+    OMITTED_TOOL_OUTPUT = "[tool output omitted from an earlier turn]"
+
+    def __init__(self, system_message: dict, token_budget: int = 8000) -> None:
+        self.system_message = system_message
+        self.token_budget = token_budget
+        self.turns: List[List[dict]] = []
+        self.evicted_turns = 0
+
+    def start_turn(self, message: dict) -> None:
+        self.turns.append([message])
+
+    def append(self, message: dict) -> None:
+        self.turns[-1].append(message)
+
+    def select_turns(self) -> Tuple[List[List[dict]], int]:
+        """Returns the turns that fit in the budget, as they are sent, and the number of oldest turns that do not."""
+        compacted = [
+            turn if t == len(self.turns) - 1 else [
+                {**message, "content": self.OMITTED_TOOL_OUTPUT} if message["role"] == "tool" else message
+                for message in turn
+            ]
+            for t, turn in enumerate(self.turns)
+        ]
+        used = message_tokens(self.system_message)
+        kept: List[List[dict]] = []
+        # Newest turns first, the current turn is always kept
+        for turn in reversed(compacted):
+            turn_tokens = sum(message_tokens(message) for message in turn)
+            if kept and used + turn_tokens > self.token_budget:
+                break
+            kept.insert(0, turn)
+            used += turn_tokens
+        return kept, len(self.turns) - len(kept)
+
+    def messages(self) -> List[dict]:
+        kept, evicted = self.select_turns()
+        # Evicted turns are dropped for good, they would never fit again
+        if evicted:
+            self.turns = self.turns[evicted:]
+            self.evicted_turns += evicted
+        return [self.system_message] + [message for turn in kept for message in turn]
+
+    def tokens(self) -> int:
+        # Size of the next request, without evicting anything
+        kept, _ = self.select_turns()
+        return message_tokens(self.system_message) + sum(message_tokens(message) for turn in kept for message in turn)
+
+def run_tool_call(tool_call, search: ChromaSearch) -> Tuple[object, str, float]:
+    """Runs one tool call and returns it with its processed output and latency."""
+    start = time.perf_counter()
+    function_name = tool_call.function.name
+    parameters = json.loads(tool_call.function.arguments)
+    # Execute the function against the session's collection
+    function_result = execute_function(function_name, parameters, search)
+    # Additional processing on the function result
+    processed_result = additional_processing(function_result) if function_name == "chroma_query" else function_result
+    return tool_call, processed_result, time.perf_counter() - start
+
+def execute_function(function_name: str, parameters: dict, search: ChromaSearch):
     if function_name == "chroma_query":
-        collection_name = hard_coded_params['collection_name']  # Hardcoded collection name
-        database_path = hard_coded_params['database_path']  # Hardcoded database path
         query = parameters.get("query")
         n_results = parameters.get("n_results")
-        return chroma_query(collection_name, database_path, query, n_results)
+        return search.query(query, n_results)
     return "Function not recognized."
 
 
-def run_tools_agent(system_prompt: Prompt, hard_coded_params: dict):
+def run_tools_agent(system_prompt: Prompt, hard_coded_params: dict, context_tokens: int = 8000):
     tools = [
         {
             "type": "function",
             "function": {
                 "name": "chroma_query",
-                "description": "Query a Chroma collection to retrieve documents based on a query string.",
+                "description": "Query a Chroma collection to retrieve short passages of the documentation based on a query string.",
                 "parameters": {
                     "type": "object",
                     "properties": {
@@ -68,7 +331,7 @@ def run_tools_agent(system_prompt: Prompt, hard_coded_params: dict):
                         },
                         "n_results": {
                             "type": "integer",
-                            "description": "The number of results to return."
+                            "description": "The number of passages to return, each is a few sentences long."
                         }
                     },
                     "required": ["query", "n_results"],
@@ -78,64 +341,83 @@ def run_tools_agent(system_prompt: Prompt, hard_coded_params: dict):
         }
     ]
 
-    messages = []
-    messages.append({"role": "system", "content": system_prompt.render()})
+    # One client and collection handle for the whole session
+    search = ChromaSearch(hard_coded_params['collection_name'], hard_coded_params['database_path'])
+
+    window = ConversationWindow({"role": "system", "content": system_prompt.render()}, context_tokens)
     model = "gpt-4o-mini"
     
     while True:
-        human_input = input("You: ")
-        messages.append({"role": "user", "content": human_input})
+        try:
+            human_input = input("You: ")
+        except (EOFError, KeyboardInterrupt):
+            stats = search.stats()
+            print(f"\nChroma queries: {stats['queries']} ({stats['hits']} cached), mean {stats['mean_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms")
+            return
+        turn_start = time.perf_counter()
+        window.start_turn({"role": "user", "content": human_input})
         response = openai.chat.completions.create(
             model=model,
-            messages=messages,
+            messages=window.messages(),
             tools=tools,
         )
         
         assistant_message = response.choices[0].message.content
         print('\n', response, '\n')
+        processed_results = []
         
         # Check if the response includes a function call
-        if response.choices[0].message.tool_calls:
-            for tool_call in response.choices[0].message.tool_calls:
-                function_name = tool_call.function.name
-                parameters = json.loads(tool_call.function.arguments)
-                
-                # Execute the function with hard-coded parameters
-                function_result = execute_function(function_name, parameters, hard_coded_params)
-                
-                # Additional processing on the function result
-                processed_result = additional_processing(function_result)
-                
-                # Use the processed result to make another inference (calling the API again)
-                messages.append({"role": "function", "name": function_name, "content": processed_result})
-                inference_response = openai.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                )
-                
-                inference_message = inference_response.choices[0].message.content
-                messages.append({"role": "assistant", "content": inference_message})
-                print("Agent:", inference_message)
+        tool_calls = response.choices[0].message.tool_calls
+        if tool_calls:
+            window.append({
+                "role": "assistant",
+                "content": assistant_message,
+                "tool_calls": [
+                    {"id": tool_call.id, "type": "function", "function": {"name": tool_call.function.name, "arguments": tool_call.function.arguments}}
+                    for tool_call in tool_calls
+                ],
+            })
+            # All the tool calls of the turn run at once, in the order the model asked for them
+            with ThreadPoolExecutor(max_workers=len(tool_calls)) as executor:
+                for tool_call, processed_result, elapsed in executor.map(lambda tool_call: run_tool_call(tool_call, search), tool_calls):
+                    print(f"{tool_call.function.name} took {elapsed * 1000:.1f} ms")
+                    window.append({"role": "tool", "tool_call_id": tool_call.id, "content": processed_result})
+                    processed_results.append(processed_result)
+            print(f"Chroma cache: {search.counters['hits']} hits / {search.counters['misses']} misses")
+            
+            # One inference over all the tool outputs (calling the API again)
+            inference_response = openai.chat.completions.create(
+                model=model,
+                messages=window.messages(),
+            )
+            
+            inference_message = inference_response.choices[0].message.content
+            window.append({"role": "assistant", "content": inference_message})
+            print("Agent:", inference_message)
         else:
-            messages.append({"role": "assistant", 'content': assistant_message})
+            window.append({"role": "assistant", 'content': assistant_message})
             print("Agent:", assistant_message)
+        print(f"Turn took {time.perf_counter() - turn_start:.2f}s, context {window.tokens()} tokens ({window.evicted_turns} turns evicted)")
         
         # Save conversation to a file
         with open('saved_conversation.txt', 'a') as f:
             f.write(f"User: {human_input}\n")
             f.write(f"Agent: {assistant_message}\n")
-            if 'processed_result' in locals():
-                f.write(f"Processed Result: {processed_result}\n")
+            if processed_results:
+                f.write(f"Processed Result: {''.join(processed_results)}\n")
                 f.write(f"Inference based on Processed Result: {inference_message}\n")
 
 def main(args):
+    if args.trace_file:
+        tracer.enable()
+
     hard_coded_params = {
         'collection_name': args.collection_name,
         'database_path': args.database_dir
     }
 
     if args.command == "create":
-        create_collection(args.collection_name, args.database_dir, args.pdf_file)
+        create_collection(args.collection_name, args.database_dir, args.pdf_file, args.sources, args.batch_size, args.workers, args.chunk_size, args.chunk_overlap, args.chunk_unit)
     elif args.command == "agent":
         system_prompt = """
         You are an advanced AI assistant integrated with a specialized database. When given data from the database, your task is to analyze the information and use it to develop a thoughtful and accurate response to the user's question.
@@ -150,24 +432,37 @@ def main(args):
 
         """
         system_prompt = Prompt(instructions=system_prompt)  # You may need to customize this based on your `Prompt` class
-        run_tools_agent(system_prompt, hard_coded_params)
+        run_tools_agent(system_prompt, hard_coded_params, args.context_tokens)
+
+    if args.trace_file:
+        tracer.write(args.trace_file)
+        print(tracer.summary())
+        print(f"Trace saved to {args.trace_file}")
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="This is a description of the program.")
+    parser.add_argument('--trace_file', default=None, help="Record spans of the Chroma queries to this file (Chrome trace format) and print a summary")
     subparsers = parser.add_subparsers(title="Commands", dest="command")
 
     # Parser for the 'create' command
-    create_parser = subparsers.add_parser("create", help="Create the Collection")
+    create_parser = subparsers.add_parser("create", help="Create or update the Collection")
     create_parser.add_argument('--database_dir', required=True, help="Path to the database directory")
-    create_parser.add_argument('--collection_name', required=True, help="Name of the collection to create")
-    create_parser.add_argument('--pdf_file', required=True, help="Path to the PDF file to parse")
+    create_parser.add_argument('--collection_name', required=True, help="Name of the collection to create or update")
+    create_parser.add_argument('--pdf_file', required=True, nargs='+', help="Path to the PDF file(s) to parse")
+    create_parser.add_argument('--sources', nargs='+', default=None, help="Source name of each PDF file (defaults to the file names)")
+    create_parser.add_argument('--batch_size', type=int, default=256, help="Number of chunks embedded and upserted per call (capped at Chroma's maximum batch size)")
+    create_parser.add_argument('--workers', type=int, default=None, help="Number of processes extracting pages (defaults to the CPU count)")
+    create_parser.add_argument('--chunk_size', type=int, default=200, help="Size of each indexed passage, in chunk units")
+    create_parser.add_argument('--chunk_overlap', type=int, default=40, help="Number of chunk units shared by consecutive passages")
+    create_parser.add_argument('--chunk_unit', choices=["words", "sentences"], default="words", help="Unit of --chunk_size and --chunk_overlap")
 
     # Parser for the 'agent' command
     agent_parser = subparsers.add_parser('agent', help='Run the AI Agent')
     agent_parser.add_argument('--num_responses', required=True, help='Number of responses the agent should generate')
     agent_parser.add_argument('--database_dir', required=True, help="Path to the database directory")
     agent_parser.add_argument('--collection_name', required=True, help="Name of the collection to use")
+    agent_parser.add_argument('--context_tokens', type=int, default=8000, help="Token budget of the conversation sent to the model each turn")
 
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+from github_client import GithubCommitResponse
+
+STATE_FILE_NAME = "pipeline_state.json"
+STATE_VERSION = 2
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class PipelineState:
+    """
+    Checkpoint of a notebook run kept in the output folder: the settings it ran with, the
+    commits it processed (SHA and metadata only, their diffs are read back from the SHA-keyed
+    GitHub cache or the mirror), the hashes of the references and metadata prompts, and the
+    generations of every iteration. A run with different settings starts from an empty state.
+    """
+
+    def __init__(self, path: str, settings: Dict[str, Any]) -> None:
+        self.path = path
+        self.settings = settings
+        self.commits: List[Dict[str, Any]] = []
+        self.references_hash: Optional[str] = None
+        self.metadata_hash: Optional[str] = None
+        self.responses: List[Tuple[str, str, str, str]] = []
+
+    @classmethod
+    def load(cls, output_folder: str, settings: Dict[str, Any]) -> 'PipelineState':
+        state = cls(os.path.join(output_folder, STATE_FILE_NAME), settings)
+        if not os.path.isfile(state.path):
+            return state
+        with open(state.path, "r") as f:
+            data = json.load(f)
+        if data.get("version") != STATE_VERSION or data.get("settings") != settings:
+            print("Pipeline settings changed, ignoring the previous checkpoint.")
+            return state
+        state.commits = data["commits"]
+        state.references_hash = data["references_hash"]
+        state.metadata_hash = data["metadata_hash"]
+        state.responses = [tuple(response) for response in data["responses"]]
+        return state
+
+    def save(self) -> None:
+        data = {
+            "version": STATE_VERSION,
+            "settings": self.settings,
+            "commits": self.commits,
+            "references_hash": self.references_hash,
+            "metadata_hash": self.metadata_hash,
+            "responses": [list(response) for response in self.responses],
+        }
+        # Write to a temporary file first, so an interrupted run never leaves a broken checkpoint
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    @property
+    def shas(self) -> List[str]:
+        return [commit["sha"] for commit in self.commits]
+
+    def set_commits(self, commits: List[GithubCommitResponse]) -> None:
+        self.commits = [
+            {
+                "sha": commit.sha,
+                "message": commit.message,
+                "committed_date": commit.committed_date,
+                "author_name": commit.author_name,
+                "author_email": commit.author_email,
+                "url": commit.url,
+            }
+            for commit in commits
+        ]
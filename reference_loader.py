@@ -0,0 +1,257 @@
+import codecs
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import chardet
+from sqlite_store import SqliteStore
+from tracing import tracer
+
+
+class ReferenceResult:
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.status_code: Optional[int] = None
+        self.elapsed = 0.0
+        self.bytes = 0
+        self.title = "No Title"
+        self.content = ""
+        # Set when the page could not be fetched or has no text
+        self.error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class ParagraphExtractor(HTMLParser):
+    """
+    Streaming replacement for BeautifulSoup here: collects the page title and the text of
+    the <p> elements as the page is fed in, and reports when max_chars of paragraph text
+    have been seen so the download can stop early.
+    """
+
+    def __init__(self, max_chars: int) -> None:
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.title: Optional[str] = None
+        self.paragraphs: List[str] = []
+        self.has_text = False
+        self._in_title = False
+        self._paragraph_depth = 0
+        self._skip_depth = 0
+        self._length = 0
+
+    @property
+    def done(self) -> bool:
+        return self._length >= self.max_chars
+
+    @property
+    def content(self) -> str:
+        return ' '.join(self.paragraphs)
+
+    def handle_starttag(self, tag: str, attrs) -> None:
+        if tag in ("script", "style"):
+            self._skip_depth += 1
+        elif tag == "title" and self.title is None:
+            self._in_title = True
+            self.title = ""
+        elif tag == "p":
+            if self._paragraph_depth == 0:
+                self.paragraphs.append("")
+            self._paragraph_depth += 1
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in ("script", "style") and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag == "title":
+            self._in_title = False
+        elif tag == "p" and self._paragraph_depth:
+            self._paragraph_depth -= 1
+
+    def handle_data(self, data: str) -> None:
+        if self._skip_depth:
+            return
+        if data.strip():
+            self.has_text = True
+        if self._in_title:
+            self.title += data
+        elif self._paragraph_depth:
+            self.paragraphs[-1] += data
+            self._length += len(data) + 1
+
+
+META_CHARSET_PATTERN = re.compile(rb"""<meta[^>]+charset=["']?([\w.:-]+)""", re.IGNORECASE)
+
+
+def detect_encoding(response: requests.Response, head: bytes) -> str:
+    """
+    Encoding of a streamed page: the charset of the Content-Type header, else the <meta charset>
+    of the first chunk, else a guess from the first chunk. requests falls back to ISO-8859-1 for
+    any text/* response without a charset, which garbles most UTF-8 pages.
+    """
+    if "charset=" in response.headers.get("Content-Type", "").lower() and response.encoding:
+        return response.encoding
+    candidates = []
+    match = META_CHARSET_PATTERN.search(head)
+    if match:
+        candidates.append(match.group(1).decode("ascii"))
+    if chardet is not None:
+        candidates.append(chardet.detect(head)["encoding"])
+    for encoding in candidates:
+        try:
+            name = codecs.lookup(encoding).name
+        except (LookupError, TypeError):
+            continue
+        # A guess of ASCII only means the first chunk had no other characters
+        return "utf-8" if name == "ascii" else name
+    return "utf-8"
+
+
+class ReferenceCache(SqliteStore):
+    """
+    Persistent store of the extracted title and text of each reference page, together with
+    the ETag/Last-Modified validators of the response. Entries younger than ttl seconds are
+    used without any request, older ones are revalidated with a conditional request and
+    only re-parsed when the page changed.
+    """
+
+    def __init__(self, cache_dir: str, ttl: float = 24 * 3600, max_bytes: int = 64 * 1024 * 1024) -> None:
+        super().__init__(cache_dir, "reference_cache.sqlite", "pages", ["etag", "last_modified", "title", "content", "fetched_at"],
+                         max_bytes, ["fresh", "revalidated", "misses"])
+        self.ttl = ttl
+
+    def get(self, url: str) -> Optional[Tuple[Optional[str], Optional[str], str, str, float]]:
+        """Returns (etag, last_modified, title, content, fetched_at) of a page."""
+        return self.get_row(url)
+
+    def put(self, url: str, etag: Optional[str], last_modified: Optional[str], title: str, content: str) -> None:
+        self.put_row(url, (etag, last_modified, title, content, time.time()), len((title + content).encode("utf-8")))
+
+    def touch(self, url: str) -> None:
+        self.update_row(url, fetched_at=time.time())
+
+
+class ReferenceLoader:
+    """
+    Downloads every reference link concurrently over one pooled session, with a timeout
+    per request, and validates and extracts the title and paragraph text from the same
+    response, so each page is fetched only once per run. Pages are streamed through
+    ParagraphExtractor and the download stops once max_chars of text are extracted.
+    With a ReferenceCache, unchanged pages skip the network and the parsing entirely.
+    The result of each URL is kept for the lifetime of the loader, so notebooks sharing the
+    loader (see run_notebook_jobs) fetch a common reference once, even concurrently.
+    """
+
+    def __init__(self, max_workers: int = 8, timeout: float = 15.0, cache: Optional[ReferenceCache] = None, max_chars: int = 500) -> None:
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.cache = cache
+        self.max_chars = max_chars
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._results: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def fetch_all(self, links: List[str]) -> List[ReferenceResult]:
+        # map() keeps the order of the reference file
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(links)))) as executor:
+            return list(executor.map(self.fetch, links))
+
+    def fetch(self, link: str) -> ReferenceResult:
+        # The first caller of a URL fetches it, the others wait for its result
+        with self._lock:
+            future = self._results.get(link)
+            owner = future is None
+            if owner:
+                future = self._results[link] = Future()
+        if owner:
+            try:
+                future.set_result(self.load(link))
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def load(self, link: str) -> ReferenceResult:
+        result = ReferenceResult(link)
+        start = time.perf_counter()
+        with tracer.span("reference_fetch", url=link) as span:
+            try:
+                cached = self.cache.get(link) if self.cache else None
+                if cached and time.time() - cached[4] < self.cache.ttl:
+                    # Fresh entry, no request at all
+                    self.cache.record("fresh")
+                    result.status_code = 200
+                    result.title, result.content = cached[2], cached[3]
+                    span.set(cache="fresh")
+                else:
+                    span.set(cache=self.download(result, cached))
+            except Exception as e:
+                result.error = str(e)
+                span.set(error=result.error)
+            span.set(bytes=result.bytes, status=result.status_code)
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    def download(self, result: ReferenceResult, cached: Optional[Tuple]) -> str:
+        """Fetches the page into result, returns "revalidated" when the cached copy was still valid and "miss" otherwise."""
+        headers = {}
+        if cached and cached[0]:
+            headers["If-None-Match"] = cached[0]
+        if cached and cached[1]:
+            headers["If-Modified-Since"] = cached[1]
+
+        with self.session.get(result.url, timeout=self.timeout, headers=headers, stream=True) as response:
+            result.status_code = response.status_code
+            if response.status_code == 304 and cached:
+                self.cache.record("revalidated")
+                self.cache.touch(result.url)
+                result.status_code = 200
+                result.title, result.content = cached[2], cached[3]
+                return "revalidated"
+            if response.status_code != 200:
+                raise ValueError(f"Status code {response.status_code}")
+            self.extract(result, response)
+
+        if self.cache:
+            self.cache.record("misses")
+            self.cache.put(result.url, response.headers.get("ETag"), response.headers.get("Last-Modified"), result.title, result.content)
+        return "miss"
+
+    def extract(self, result: ReferenceResult, response: requests.Response) -> None:
+        parser = ParagraphExtractor(self.max_chars)
+        decoder = None
+        for chunk in response.iter_content(chunk_size=16384):
+            result.bytes += len(chunk)
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder(detect_encoding(response, chunk))(errors="replace")
+            parser.feed(decoder.decode(chunk))
+            if parser.done:
+                # Enough text for the prompt, the rest of the page is never downloaded
+                break
+        else:
+            if decoder is not None:
+                parser.feed(decoder.decode(b"", final=True))
+            parser.close()
+
+        if not parser.has_text:
+            raise ValueError("No valid content found")
+
+        # Extract the title of the page and all paragraph texts
+        result.title = parser.title.strip() if parser.title else "No Title"
+        result.content = parser.content
+
+
+def reference_report(results: List[ReferenceResult]) -> str:
+    """Per-link latency and status table."""
+    lines = [f"{'Status':<8}{'Time (s)':>10}{'KB':>10}  URL"]
+    for result in results:
+        status = str(result.status_code) if result.status_code is not None else "ERR"
+        lines.append(f"{status:<8}{result.elapsed:>10.2f}{result.bytes / 1024:>10.1f}  {result.url}" + (f"  ({result.error})" if result.error else ""))
+    return "\n".join(lines)
@@ -0,0 +1,128 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+import requests
+
+# Statuses that are worth retrying, 403 is only retried when it is a rate limit
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RequestScheduler:
+    """
+    Sends GitHub requests on behalf of one or more clients while keeping them under the
+    rate limit. It tracks `X-RateLimit-Remaining`/`X-RateLimit-Reset` from every response,
+    retries rate-limited, 5xx and connection failures with jittered exponential backoff
+    (or for as long as `Retry-After` asks), and once the remaining quota drops under
+    low_water_ratio of the limit it spaces requests out evenly until the window resets.
+    A single scheduler can be shared by several clients so they draw from one budget.
+    """
+
+    def __init__(self, max_retries: int = 5, backoff_base: float = 1.0, backoff_max: float = 60.0, low_water_ratio: float = 0.1) -> None:
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.low_water_ratio = low_water_ratio
+
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        self.reset_at: Optional[float] = None
+
+        self.requests_sent = 0
+        self.retries = 0
+        self.not_modified = 0
+
+        self._lock = threading.Lock()
+        # Every thread waits until this time before sending, set by pacing and by Retry-After
+        self._next_slot = 0.0
+
+    def send(self, send_request: Callable[[], requests.Response]) -> requests.Response:
+        attempt = 0
+        while True:
+            self._wait_for_slot()
+            try:
+                response = send_request()
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                self._retry_after(self._backoff(attempt), rate_limited=False)
+                attempt += 1
+                continue
+
+            self._update(response)
+            retry = self._retry_delay(response, attempt)
+            if retry is None or attempt >= self.max_retries:
+                return response
+            self._retry_after(*retry)
+            attempt += 1
+
+    def usage(self) -> Dict[str, Optional[int]]:
+        """Quota used by this scheduler so far, 304 responses are free."""
+        with self._lock:
+            return {
+                "requests": self.requests_sent,
+                "retries": self.retries,
+                "not_modified": self.not_modified,
+                "quota_used": self.requests_sent - self.not_modified,
+                "remaining": self.remaining,
+                "limit": self.limit,
+            }
+
+    def _wait_for_slot(self) -> None:
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_slot)
+            if self.remaining is not None and self.limit and self.reset_at:
+                window_left = max(self.reset_at - now, 0.0)
+                if self.remaining <= 0:
+                    # Budget spent, nothing gets through before the reset
+                    slot = max(slot, self.reset_at)
+                elif self.remaining < self.limit * self.low_water_ratio:
+                    # Spread what is left of the budget over the rest of the window
+                    self._next_slot = slot + window_left / self.remaining
+            delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def _update(self, response: requests.Response) -> None:
+        with self._lock:
+            self.requests_sent += 1
+            if response.status_code == 304:
+                self.not_modified += 1
+            headers = response.headers
+            if "X-RateLimit-Remaining" in headers:
+                self.remaining = int(headers["X-RateLimit-Remaining"])
+            if "X-RateLimit-Limit" in headers:
+                self.limit = int(headers["X-RateLimit-Limit"])
+            if "X-RateLimit-Reset" in headers:
+                self.reset_at = float(headers["X-RateLimit-Reset"])
+
+    def _retry_delay(self, response: requests.Response, attempt: int) -> Optional[Tuple[float, bool]]:
+        """Seconds to wait before retrying and whether it was a rate limit, or None when it should not be retried."""
+        status = response.status_code
+        rate_limited = status == 429 or (status == 403 and (
+            "Retry-After" in response.headers
+            or response.headers.get("X-RateLimit-Remaining") == "0"
+            or "rate limit" in response.text.lower()
+        ))
+        if not rate_limited and status not in RETRY_STATUS_CODES:
+            return None
+
+        if "Retry-After" in response.headers:
+            return float(response.headers["Retry-After"]), rate_limited
+        if rate_limited and response.headers.get("X-RateLimit-Remaining") == "0" and "X-RateLimit-Reset" in response.headers:
+            return max(float(response.headers["X-RateLimit-Reset"]) - time.time(), 0.0) + 1.0, True
+        return self._backoff(attempt), rate_limited
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter, so concurrent workers do not retry in lockstep
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _retry_after(self, delay: float, rate_limited: bool) -> None:
+        with self._lock:
+            self.retries += 1
+            if rate_limited:
+                # Hold back the other workers as well, they would hit the same limit
+                self._next_slot = max(self._next_slot, time.time() + delay)
+                return
+        time.sleep(delay)
@@ -0,0 +1,85 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class SqliteStore:
+    """
+    Base of the on-disk caches: one SQLite table keyed on `key`, holding the columns of
+    the subclass plus the size and last access time of every row. Every access goes through
+    one lock, since the callers fetch from thread pools. Once the total stored size goes
+    over max_bytes the least recently used rows are evicted.
+    """
+
+    def __init__(self, cache_dir: str, file_name: str, table: str, columns: List[str], max_bytes: int, counters: List[str]) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, file_name)
+        self.table = table
+        self.columns = columns
+        self.max_bytes = max_bytes
+        self.counters = {name: 0 for name in counters + ["evictions"]}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+
+        # A table from an older layout is only a cache, it is rebuilt rather than migrated
+        layout = ["key"] + columns + ["size", "last_access"]
+        existing = [row[1] for row in self._conn.execute(f"PRAGMA table_info({table})").fetchall()]
+        if existing and existing != layout:
+            self._conn.execute(f"DROP TABLE {table}")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, "
+            + "".join(f"{column}, " for column in columns) + "size INTEGER, last_access REAL)"
+        )
+        self._conn.commit()
+
+    def get_row(self, key: str) -> Optional[Tuple]:
+        """Returns the columns of the row and marks it as used, or None."""
+        with self._lock:
+            row = self._conn.execute(f"SELECT {', '.join(self.columns)} FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute(f"UPDATE {self.table} SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+            return row
+
+    def put_row(self, key: str, values: Tuple, size: int) -> None:
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, {', '.join(self.columns)}, size, last_access) "
+                f"VALUES ({', '.join('?' * (len(self.columns) + 3))})",
+                (key, *values, size, time.time())
+            )
+            self._evict()
+            self._conn.commit()
+
+    def update_row(self, key: str, **values: Any) -> None:
+        with self._lock:
+            assignments = ", ".join(f"{column} = ?" for column in values)
+            self._conn.execute(f"UPDATE {self.table} SET {assignments} WHERE key = ?", (*values.values(), key))
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        # Drop the least recently used rows until the store fits under max_bytes
+        total = self._conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute(f"SELECT key, size FROM {self.table} ORDER BY last_access ASC").fetchall():
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self.counters["evictions"] += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def record(self, outcome: str) -> None:
+        with self._lock:
+            self.counters[outcome] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries, size = self._conn.execute(f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}").fetchone()
+            return {**self.counters, "entries": entries, "bytes": size}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,60 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from tracing import tracer
+
+
+class TaskGraph:
+    """
+    Runs a small dependency graph of callables on a thread pool. Each task is started as
+    soon as the tasks it depends on have finished, and receives their results as
+    positional arguments in the order the dependencies were listed. The first failing
+    task stops the graph and its exception is raised from run().
+    """
+
+    def __init__(self, max_workers: int = 4) -> None:
+        self.max_workers = max(1, max_workers)
+        self.tasks: Dict[str, Tuple[Callable[..., Any], List[str]]] = {}
+        # Wall-clock seconds spent in each task, filled by run()
+        self.timings: Dict[str, float] = {}
+
+    def add(self, name: str, function: Callable[..., Any], depends_on: Optional[List[str]] = None) -> None:
+        if name in self.tasks:
+            raise ValueError(f"Task {name} is already defined")
+        for dependency in depends_on or []:
+            if dependency not in self.tasks:
+                raise ValueError(f"Task {name} depends on undefined task {dependency}")
+        self.tasks[name] = (function, list(depends_on or []))
+
+    def run(self) -> Dict[str, Any]:
+        results: Dict[str, Any] = {}
+        running: Dict[Future, str] = {}
+        pending = dict(self.tasks)
+
+        def timed(name: str, function: Callable[..., Any], args: List[Any]) -> Any:
+            start = time.perf_counter()
+            try:
+                with tracer.span(f"stage:{name}"):
+                    return function(*args)
+            finally:
+                self.timings[name] = time.perf_counter() - start
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while pending or running:
+                # Start every task whose dependencies are all done, in definition order
+                for name, (function, depends_on) in list(pending.items()):
+                    if all(dependency in results for dependency in depends_on):
+                        del pending[name]
+                        running[executor.submit(timed, name, function, [results[d] for d in depends_on])] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        raise future.exception()
+                    results[name] = future.result()
+        finally:
+            # On failure, tasks that have not started yet are dropped instead of awaited
+            executor.shutdown(wait=not running, cancel_futures=True)
+        return results
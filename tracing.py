@@ -0,0 +1,125 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List
+
+
+class Span:
+    """One timed operation. Attributes such as bytes, tokens_in, tokens_out and cache are set with set()."""
+
+    __slots__ = ("tracer", "name", "attributes", "start", "duration", "thread_id")
+
+    recording = True
+
+    def __init__(self, tracer: "Tracer", name: str, attributes: Dict[str, Any]) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.start = 0.0
+        self.duration = 0.0
+        self.thread_id = 0
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> "Span":
+        self.thread_id = threading.get_ident()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.tracer.record(self)
+
+
+class NullSpan:
+    """Span handed out while tracing is disabled, every call is a no-op."""
+
+    recording = False
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+    def __enter__(self) -> "NullSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+# Attributes summed up per span name in the summary table
+SUMMED_ATTRIBUTES = ["bytes", "tokens_in", "tokens_out"]
+
+
+class Tracer:
+    """
+    Collects spans from every thread of the run. While disabled, span() returns NULL_SPAN
+    without recording anything, so instrumented code costs one attribute check. Callers that
+    compute attributes (e.g. token counts) only do so when span.recording is set. The spans
+    are written in the Chrome trace event format (chrome://tracing, Perfetto) by write().
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def enable(self) -> None:
+        self.enabled = True
+        self._origin = time.perf_counter()
+
+    def span(self, name: str, **attributes: Any):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, attributes)
+
+    def record(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def write(self, file_path: str) -> None:
+        with self._lock:
+            spans = list(self.spans)
+        events = [
+            {
+                "name": span.name,
+                "ph": "X",
+                "ts": round((span.start - self._origin) * 1e6),
+                "dur": round(span.duration * 1e6),
+                "pid": os.getpid(),
+                "tid": span.thread_id,
+                "args": span.attributes,
+            }
+            for span in spans
+        ]
+        with open(file_path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self) -> str:
+        """Count, time, bytes, tokens and cache hits of the spans, grouped by name."""
+        with self._lock:
+            spans = list(self.spans)
+        groups: Dict[str, List[Span]] = {}
+        for span in spans:
+            groups.setdefault(span.name, []).append(span)
+
+        lines = [f"{'Span':<28}{'Count':>7}{'Total (s)':>11}{'Mean (ms)':>11}{'Max (ms)':>10}{'KB':>10}{'Tok in':>9}{'Tok out':>9}{'Cached':>8}"]
+        for name, group in sorted(groups.items(), key=lambda item: -sum(span.duration for span in item[1])):
+            total = sum(span.duration for span in group)
+            sums = [sum(span.attributes.get(attribute) or 0 for span in group) for attribute in SUMMED_ATTRIBUTES]
+            cached = sum(1 for span in group if span.attributes.get("cache") in ("hit", "fresh", "revalidated"))
+            lines.append(
+                f"{name:<28}{len(group):>7}{total:>11.2f}{1000 * total / len(group):>11.1f}{1000 * max(span.duration for span in group):>10.1f}"
+                f"{sums[0] / 1024:>10.1f}{sums[1]:>9}{sums[2]:>9}{cached:>8}"
+            )
+        return "\n".join(lines)
+
+
+# Shared by every module, enabled by the entry points when a trace file is requested
+tracer = Tracer()